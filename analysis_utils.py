@@ -1,8 +1,15 @@
 import datetime
 
+import numpy as np
+import pandas as pd
+
+GENESIS_DATE = '2009-01-03'
+HALVING_DATES = ['2012-11-29', '2016-07-10', '2020-05-11']
+MARKET_CYCLE_DATES = ['2011-11-18', '2015-01-14', '2018-12-16']
+
 def get_halving_era(date):
-    era = datetime.datetime.strptime('2009-01-03', "%Y-%m-%d")
-    halvings = ['2012-11-29', '2016-07-10', '2020-05-11']
+    era = datetime.datetime.strptime(GENESIS_DATE, "%Y-%m-%d")
+    halvings = HALVING_DATES
     for halving in halvings:
         halving = datetime.datetime.strptime(halving, "%Y-%m-%d")
         if date >= halving:
@@ -12,8 +19,8 @@ def get_halving_era(date):
     return era.date()
 
 def get_market_cycle(date):
-    cycle = datetime.datetime.strptime('2009-01-03', "%Y-%m-%d")
-    cycle_dates = ['2011-11-18', '2015-01-14', '2018-12-16']
+    cycle = datetime.datetime.strptime(GENESIS_DATE, "%Y-%m-%d")
+    cycle_dates = MARKET_CYCLE_DATES
     for cycle_date in cycle_dates:
         cycle_date = datetime.datetime.strptime(cycle_date, "%Y-%m-%d")
         if date >= cycle_date:
@@ -22,17 +29,227 @@ def get_market_cycle(date):
             return cycle.date()
     return cycle.date()
 
+def _event_lookup(datetimes, event_dates):
+    ''' Map each datetime to the latest of GENESIS_DATE and event_dates on or before it, as datetime.date objects '''
+    starts = np.array([GENESIS_DATE] + list(event_dates), dtype='datetime64[D]')
+    index = np.searchsorted(starts[1:], datetimes.values.astype('datetime64[D]'), side='right')
+    return starts.astype(object)[index]
+
 def get_extra_datetime_cols(df, datecol, date_format="%Y-%m-%d"):
-    df['datetime'] = [datetime.datetime.strptime(x, date_format) for x in df[datecol]]
-    df['year'] = [datetime.date(x.year, 1, 1) for x in df['datetime']]
-    df['month'] = [datetime.date(x.year, x.month, 1) for x in df['datetime']]
-    df['week'] = [(x - datetime.timedelta(days=(x.weekday() + 1))) for x in df['datetime']]
-    df['rhr_week'] = [(x - datetime.timedelta(days=((x.weekday() - 3) % 7))) for x in df['datetime']]
+    if pd.api.types.is_datetime64_any_dtype(df[datecol]):
+        datetimes = df[datecol]
+    else:
+        datetimes = pd.to_datetime(df[datecol], format=date_format)
+    days = datetimes.values.astype('datetime64[D]')
+    df['datetime'] = datetimes
+    df['year'] = days.astype('datetime64[Y]').astype('datetime64[D]').astype(object)
+    df['month'] = days.astype('datetime64[M]').astype('datetime64[D]').astype(object)
+    df['week'] = datetimes - pd.to_timedelta(datetimes.dt.weekday + 1, unit='D')
+    df['rhr_week'] = datetimes - pd.to_timedelta((datetimes.dt.weekday - 3) % 7, unit='D')
     df['day'] = df['date']
-    df['halving_era'] = [get_halving_era(x) for x in df['datetime']]
-    df['market_cycle'] = [get_market_cycle(x) for x in df['datetime']]
+    df['halving_era'] = _event_lookup(datetimes, HALVING_DATES)
+    df['market_cycle'] = _event_lookup(datetimes, MARKET_CYCLE_DATES)
     return df
 
+def align_to_events(df, y_series, x_series='date', events=None, curve_series=None, days_series=None,
+                    normalize=None, max_days=None):
+    """
+        Align a metric to "days since event" and pivot it into a wide (days since x curve) matrix
+
+        Arguments:
+        df (dataframe): Pandas dataframe, sorted by date within each curve
+        y_series (string): Column name of the metric to align
+        x_series (string): Column name for the date series, typically 'date'
+
+        Keyword arguments:
+        events (list): Event dates that start each curve, e.g. HALVING_DATES or MARKET_CYCLE_DATES. Each row is
+            assigned to the latest event on or before its date; rows before the first event are dropped.
+        curve_series (string): Column name that already labels each curve, e.g. 'period' in the coinbase
+            herfindahl data. Used instead of events.
+        days_series (string): Column name that already holds days since the event, e.g. 'days_since_coinbase'.
+            Defaults to the date difference for event curves and to the row position within each curve otherwise.
+        normalize (string): None, 'first' to divide each curve by its first value or 'max' to divide by its max
+        max_days (int): Drop rows more than this many days after the event
+
+        Returns:
+            Pandas dataframe indexed by days since event with one column per curve, in order of appearance. Rows
+            sharing a day since the event within a curve (e.g. hourly or per-block data) are averaged.
+
+        """
+    if events is not None:
+        dates = pd.to_datetime(df[x_series]).values
+        event_dates = pd.to_datetime(sorted(events)).values
+        event_index = np.searchsorted(event_dates, dates, side='right') - 1
+        keep = event_index >= 0
+        event_index = event_index[keep]
+        curves = pd.Categorical.from_codes(event_index, [str(x)[:10] for x in event_dates])
+        if days_series:
+            days = df[days_series].values[keep]
+        else:
+            days = (dates[keep] - event_dates[event_index]).astype('timedelta64[D]').astype(np.int64)
+        values = df[y_series].values[keep]
+    elif curve_series:
+        curves = pd.Categorical(df[curve_series], categories=df[curve_series].unique())
+        if days_series:
+            days = df[days_series].values
+        else:
+            days = df.groupby(curves, observed=True).cumcount().values
+        values = df[y_series].values
+    else:
+        raise ValueError('align_to_events needs either events or curve_series')
+
+    aligned = pd.DataFrame({'days_since': days, 'curve': curves, 'value': values})
+    if max_days is not None:
+        aligned = aligned.loc[aligned['days_since'] <= max_days]
+
+    if normalize:
+        if normalize not in ('first', 'max'):
+            raise ValueError("normalize must be None, 'first' or 'max'")
+        aligned['value'] = aligned['value'] / aligned.groupby('curve', observed=True)['value'].transform(normalize)
+
+    # Sub-daily or per-block rows land on the same whole day since the event; they are averaged into one point
+    wide = aligned.groupby(['days_since', 'curve'], observed=True)['value'].mean().unstack('curve')
+    wide = wide.loc[:, [x for x in curves.categories if x in wide.columns]]
+    wide.columns = list(wide.columns)
+    return wide
+
+# Rows per re-anchored block in _window_moments
+MOMENT_BLOCK_ROWS = 4096
+
+def _window_moments(x, y, w, valid, window=None, expanding=False, block_rows=MOMENT_BLOCK_ROWS):
+    """
+        Weighted count, means and centered second moments of x and y over each rolling or expanding window
+
+        Cumulative sums are taken over blocks of about block_rows rows, centered on each block's mean, so differencing
+        them never cancels a large offset. Rolling windows reach back into the previous block; expanding windows
+        combine the previous blocks' moments with the current block's prefix (Chan et al.'s pairwise update).
+
+        Returns:
+            Arrays of valid rows, total weight, weighted means of x and y, and the centered sums of squares and
+            cross products vxx, vxy and vyy, one per row
+
+        """
+    length = len(x)
+    out = {key: np.zeros(length) for key in ['n', 's', 'x_bar', 'y_bar', 'vxx', 'vxy', 'vyy']}
+    block_rows = max(block_rows, window or 0)
+    totals = [0.0, 0.0, 0.0, 0.0, 0.0, 0.0, 0.0]  # n, s, x_bar, y_bar, vxx, vxy, vyy of earlier blocks
+
+    for block_start in range(0, length, block_rows):
+        block_end = min(block_start + block_rows, length)
+        region_start = block_start if expanding else max(block_start - window + 1, 0)
+        region = slice(region_start, block_end)
+        v, rw = valid[region], w[region]
+        x_anchor = np.mean(x[region][v]) if v.any() else 0
+        y_anchor = np.mean(y[region][v]) if v.any() else 0
+        rx = np.where(v, x[region] - x_anchor, 0)
+        ry = np.where(v, y[region] - y_anchor, 0)
+
+        ends = np.arange(block_start, block_end) + 1 - region_start
+        starts = np.zeros_like(ends) if expanding else np.maximum(ends - window, 0)
+
+        def sums(values):
+            cumulative = np.concatenate([[0], np.cumsum(values)])
+            return cumulative[ends] - cumulative[starts]
+
+        n, s = sums(v.astype(np.float64)), sums(rw)
+        sx, sy = sums(rw * rx), sums(rw * ry)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dx, dy = np.where(s > 0, sx / s, 0), np.where(s > 0, sy / s, 0)
+            vxx = sums(rw * rx * rx) - dx * sx
+            vxy = sums(rw * rx * ry) - dx * sy
+            vyy = sums(rw * ry * ry) - dy * sy
+        x_bar, y_bar = x_anchor + dx, y_anchor + dy
+
+        if expanding:
+            t_n, t_s, t_x, t_y, t_xx, t_xy, t_yy = totals
+            total = t_s + s
+            with np.errstate(divide='ignore', invalid='ignore'):
+                share = np.where(total > 0, s / total, 0)
+                cross = np.where(total > 0, t_s * s / total, 0)
+            gx, gy = x_bar - t_x, y_bar - t_y
+            n, s = t_n + n, total
+            vxx = t_xx + vxx + gx * gx * cross
+            vxy = t_xy + vxy + gx * gy * cross
+            vyy = t_yy + vyy + gy * gy * cross
+            x_bar, y_bar = t_x + gx * share, t_y + gy * share
+            if total[-1] > 0:
+                totals = [n[-1], s[-1], x_bar[-1], y_bar[-1], vxx[-1], vxy[-1], vyy[-1]]
+
+        for key, values in zip(['n', 's', 'x_bar', 'y_bar', 'vxx', 'vxy', 'vyy'], [n, s, x_bar, y_bar, vxx, vxy, vyy]):
+            out[key][block_start:block_end] = values
+    return out['n'], out['s'], out['x_bar'], out['y_bar'], out['vxx'], out['vxy'], out['vyy']
+
+def rolling_regression(df, x_series, y_series, window=None, expanding=False, log_x=False, log_y=False,
+                       weights=None, min_periods=None, ci_z=1.96):
+    """
+        Fit y = intercept + slope * x by least squares over every rolling or expanding window in one pass
+
+        Running sums of w, wx, wy, wx^2, wxy and wy^2 are accumulated with cumsum, and each window's fit is taken
+        from the difference of two cumulative sums. The sums are re-anchored on the local mean every few thousand
+        rows (see _window_moments), so a trending regressor over millions of rows keeps the same precision as a
+        short series. Rows with missing values (or non-positive values under a log transform) are left out of every
+        window they fall in.
+
+        Arguments:
+        df (dataframe): Pandas dataframe sorted by date, e.g. the block space daily data
+        x_series (string): Column name for the regressor, e.g. 'daily_block_equivalents'
+        y_series (string): Column name for the response, e.g. 'fees_usd_per_vbyte'
+
+        Keyword arguments:
+        window (int): Number of rows in each rolling window
+        expanding (bool): Use every row up to the current one instead of a rolling window
+        log_x (bool): Regress on ln(x)
+        log_y (bool): Regress ln(y), so with log_x the slope is the elasticity
+        weights (string): Column name of observation weights
+        min_periods (int): Minimum usable rows for a fit; defaults to window, or 3 when expanding
+        ci_z (float): Normal quantile for the slope confidence band; 1.96 gives 95%
+
+        Returns:
+            Pandas dataframe on df's index with 'n', 'slope', 'intercept', 'slope_se', 'intercept_se', 'r2',
+            'slope_lower' and 'slope_upper' columns. The bands plot with
+            chart_utils.single_axis_chart2(..., confidence_interals=['slope_lower', 'slope_upper', 'slope'])
+
+        """
+    if not expanding and not window:
+        raise ValueError('rolling_regression needs a window or expanding=True')
+
+    x = df[x_series].to_numpy(dtype=np.float64)
+    y = df[y_series].to_numpy(dtype=np.float64)
+    w = df[weights].to_numpy(dtype=np.float64) if weights else np.ones(len(df))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if log_x:
+            x = np.where(x > 0, np.log(x), np.nan)
+        if log_y:
+            y = np.where(y > 0, np.log(y), np.nan)
+    valid = np.isfinite(x) & np.isfinite(y) & np.isfinite(w) & (w > 0)
+    w = np.where(valid, w, 0)
+
+    n, s, x_bar, y_bar, vxx, vxy, vyy = _window_moments(x, y, w, valid, window, expanding)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = vxy / vxx
+        intercept = y_bar - slope * x_bar
+        sse = np.maximum(vyy - slope * vxy, 0)
+        sigma2 = sse / (n - 2)
+        slope_se = np.sqrt(sigma2 / vxx)
+        intercept_se = np.sqrt(sigma2 * (1 / s + x_bar ** 2 / vxx))
+        r2 = 1 - sse / vyy
+
+    min_periods = min_periods or (3 if expanding else window)
+    fitted = (n >= max(min_periods, 3)) & (vxx > 0)
+    result = pd.DataFrame({
+        'n': n.astype(np.int64),
+        'slope': slope,
+        'intercept': intercept,
+        'slope_se': slope_se,
+        'intercept_se': intercept_se,
+        'r2': r2,
+    }, index=df.index)
+    result.loc[~fitted, ['slope', 'intercept', 'slope_se', 'intercept_se', 'r2']] = np.nan
+    result['slope_lower'] = result['slope'] - ci_z * result['slope_se']
+    result['slope_upper'] = result['slope'] + ci_z * result['slope_se']
+    return result
+
 def sats_fee_bucket(fee):
     bucket = ''
     if fee == 0:
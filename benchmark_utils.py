@@ -0,0 +1,255 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+import analysis_utils
+import chart_utils
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+SCALES = [1, 10, 100]
+SUB_DAILY_PERIODS = 24
+
+def load_dataset(name):
+    ''' Read one of the data/*.csv files by name, e.g. '02_hodl_waves' '''
+    return pd.read_csv(os.path.join(DATA_DIR, '{}.csv'.format(name)))
+
+def dataset_names():
+    ''' List the datasets available in data/ '''
+    return sorted(os.path.splitext(os.path.basename(x))[0] for x in glob.glob(os.path.join(DATA_DIR, '*.csv')))
+
+def _is_date_column(series):
+    values = series.dropna()
+    if not pd.api.types.is_string_dtype(series) or len(values) == 0:
+        return False
+    return bool(values.astype(str).str.match(r'^\d{4}-\d{2}-\d{2}').all())
+
+def synthetic_dataset(name, scale=1, periods_per_day=1, seed=0):
+    """
+        Generate a synthetic dataframe shaped like data/<name>.csv
+
+        The first date-like column becomes an ascending calendar with the same rows per date as the real file,
+        stretched to scale times as many dates. Every other column is resampled from the real column's values,
+        so dtypes, missing values and categories match the source schema.
+
+        Arguments:
+        name (string): Dataset name, e.g. '02_hodl_waves'
+        scale (int): Multiple of the real row count to generate
+        periods_per_day (int): When above 1, generate sub-daily rows with '%Y-%m-%d %H:%M:%S' timestamps
+        seed (int): Random seed
+
+        Returns:
+            Pandas dataframe
+
+        """
+    real = load_dataset(name)
+    rng = np.random.default_rng(seed)
+    n_rows = len(real) * scale * periods_per_day
+
+    date_cols = [col for col in real.columns if _is_date_column(real[col])]
+    synthetic = {}
+    for col in real.columns:
+        synthetic[col] = real[col].values[rng.integers(0, len(real), n_rows)]
+
+    if date_cols:
+        date_col = date_cols[0]
+        real_dates = np.sort(np.array(real[date_col].astype(str).str[:10], dtype='datetime64[D]'))
+        unique_dates = np.unique(real_dates)
+        step = np.median(np.diff(unique_dates)).astype(int) if len(unique_dates) > 1 else 1
+        n_dates = len(unique_dates) * scale
+        if step >= 28:
+            calendar = (unique_dates[0].astype('datetime64[M]') + np.arange(n_dates)).astype('datetime64[D]')
+        else:
+            calendar = unique_dates[0] + np.arange(n_dates) * step
+        if periods_per_day > 1:
+            calendar = calendar.astype('datetime64[s]')
+            offsets = (np.arange(periods_per_day) * (86400 // periods_per_day)).astype('timedelta64[s]')
+            calendar = (calendar[:, None] + offsets[None, :]).ravel()
+        dates = np.datetime_as_string(calendar[np.arange(n_rows) * len(calendar) // n_rows])
+        synthetic[date_col] = np.char.replace(dates, 'T', ' ').astype(object)
+
+    return pd.DataFrame(synthetic, columns=real.columns)
+
+def _hodl_waves_frame(scale, periods_per_day):
+    df = synthetic_dataset('03_hodl_waves_real_cap', scale, periods_per_day)
+    df['PriceUSD'] = df['price_usd']
+    return df
+
+def _heatmap_inputs(scale, periods_per_day):
+    df = synthetic_dataset('04_block_space_price_heat', scale, periods_per_day)
+    df = df.loc[df['bucket_type'] == 'sats']
+    aggregate_data = df.groupby(['month', 'bucket'], group_keys=False).sum()[['tx_count']]
+    return aggregate_data, df['month'].unique()
+
+def _fee_rates(scale, periods_per_day):
+    df = synthetic_dataset('04_block_space_daily', scale, periods_per_day)
+    return (df['sum_fees_sats'] / df['sum_block_vbytes']).fillna(0)
+
+def _usd_fee_rates(scale, periods_per_day):
+    df = synthetic_dataset('04_block_space_daily', scale, periods_per_day)
+    return (df['sum_fees_usd'] / df['sum_block_vbytes']).fillna(0)
+
+def _address_reuse(scale, periods_per_day):
+    df = synthetic_dataset('address_reuse', scale, periods_per_day)
+    df['PriceUSD'] = np.geomspace(0.1, 60000, len(df))
+    return df
+
+def _date_format(periods_per_day):
+    return "%Y-%m-%d %H:%M:%S" if periods_per_day > 1 else "%Y-%m-%d"
+
+# name: (setup(scale, periods_per_day) -> args, function(*args), supports sub-daily data)
+BENCHMARKS = {
+    'get_extra_datetime_cols': (
+        lambda s, p: (synthetic_dataset('02_hodl_waves', s, p)[['date']].copy(), _date_format(p)),
+        lambda df, date_format: analysis_utils.get_extra_datetime_cols(df, 'date', date_format),
+        True),
+    'sats_fee_bucket': (
+        lambda s, p: (_fee_rates(s, p),),
+        lambda fees: fees.apply(analysis_utils.sats_fee_bucket),
+        True),
+    'usd_fee_bucket': (
+        lambda s, p: (_usd_fee_rates(s, p),),
+        lambda fees: fees.apply(analysis_utils.usd_fee_bucket),
+        True),
+    'get_threshold_dates': (
+        lambda s, p: (synthetic_dataset('address_reuse', s, p),),
+        lambda df: chart_utils.get_threshold_dates(
+            df, 'date', 'pct_reused_count', df['pct_reused_count'].median()),
+        False),
+    'block_space_heatmap_data': (
+        _heatmap_inputs,
+        lambda aggregate_data, date_series: chart_utils.block_space_heatmap_data(aggregate_data, date_series),
+        False),
+    'hodl_waves_chart': (
+        lambda s, p: (_hodl_waves_frame(s, p),),
+        lambda df: chart_utils.hodl_waves_chart(df, show=False),
+        True),
+    'two_axis_chart': (
+        lambda s, p: (_address_reuse(s, p),),
+        lambda df: chart_utils.two_axis_chart(
+            df, 'date', 'pct_reused_count', 'PriceUSD', halving_lines=True, show=False),
+        True),
+    'single_axis_chart2': (
+        lambda s, p: (synthetic_dataset('lightning_fees', s, p),),
+        lambda df: chart_utils.single_axis_chart2(df, 'date', 'lightning_pct', halving_lines=True),
+        True),
+}
+
+def run_benchmark(name, scale=1, periods_per_day=1, repeat=3):
+    """
+        Time one benchmark and measure its peak memory
+
+        Arguments:
+        name (string): Key in BENCHMARKS
+        scale (int): Multiple of the real row count
+        periods_per_day (int): Rows per day for sub-daily variants
+        repeat (int): Number of timed runs; the fastest is reported
+
+        Returns:
+            Dict with the best wall time in seconds and the peak traced memory in bytes
+
+        """
+    setup, func, _ = BENCHMARKS[name]
+    timings = []
+    for _ in range(repeat):
+        args = setup(scale, periods_per_day)
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    args = setup(scale, periods_per_day)
+    tracemalloc.start()
+    try:
+        func(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {'seconds': min(timings), 'peak_bytes': peak}
+
+def benchmark_key(name, scale, periods_per_day):
+    return '{}[x{}{}]'.format(name, scale, '/{}pd'.format(periods_per_day) if periods_per_day > 1 else '')
+
+def run_suite(names=None, scales=SCALES, sub_daily=True, repeat=3):
+    ''' Run every benchmark at every scale, plus sub-daily variants at 1x, and return results keyed by benchmark '''
+    results = {}
+    for name in names or BENCHMARKS:
+        variants = [(scale, 1) for scale in scales]
+        if sub_daily and BENCHMARKS[name][2]:
+            variants.append((1, SUB_DAILY_PERIODS))
+        for scale, periods_per_day in variants:
+            key = benchmark_key(name, scale, periods_per_day)
+            results[key] = run_benchmark(name, scale, periods_per_day, repeat=repeat)
+            print('{:<45} {:>10.4f}s {:>10.1f}MB'.format(
+                key, results[key]['seconds'], results[key]['peak_bytes'] / 1e6), flush=True)
+    return results
+
+def compare_to_baseline(results, baseline, time_thresh=0.25, memory_thresh=0.25):
+    """
+        Compare benchmark results against stored baselines
+
+        Arguments:
+        results (dict): Output of run_suite
+        baseline (dict): Previously saved output of run_suite
+        time_thresh (float): Allowed fractional slowdown before a benchmark counts as a regression
+        memory_thresh (float): Allowed fractional growth in peak memory before a benchmark counts as a regression
+
+        Returns:
+            List of (benchmark key, metric, baseline value, new value) tuples for every regression
+
+        """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric, thresh in [('seconds', time_thresh), ('peak_bytes', memory_thresh)]:
+            if result[metric] > baseline[key][metric] * (1 + thresh):
+                regressions.append((key, metric, baseline[key][metric], result[metric]))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark analysis_utils and chart_utils on synthetic data')
+    parser.add_argument('benchmarks', nargs='*', help='Benchmarks to run, default all: {}'.format(
+        ', '.join(BENCHMARKS)))
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--no-sub-daily', action='store_true')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true', help='Overwrite the baseline with these results')
+    parser.add_argument('--time-thresh', type=float, default=0.25)
+    parser.add_argument('--memory-thresh', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.benchmarks, args.scales, not args.no_sub_daily, args.repeat)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print('Saved baseline to {}'.format(args.baseline))
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print('No baseline at {}; run with --save-baseline to create one'.format(args.baseline))
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare_to_baseline(results, baseline, args.time_thresh, args.memory_thresh)
+    for key, metric, old, new in regressions:
+        print('REGRESSION {} {}: {:.4g} -> {:.4g} ({:+.0%})'.format(key, metric, old, new, new / old - 1))
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,239 @@
+import collections
+import hashlib
+import inspect
+import json
+import os
+import threading
+
+import pandas as pd
+import plotly
+import plotly.graph_objects as go
+import plotly.io as pio
+
+def _as_list(series):
+    if series is None:
+        return []
+    return [series] if isinstance(series, str) else list(series)
+
+# Columns each chart_utils function reads from its dataframe, given (df, params) where params are its bound
+# arguments after the dataframe. Functions not listed here are fingerprinted on every column.
+CHART_COLUMNS = {
+    'two_axis_chart': lambda df, p: [p['x_series']] + _as_list(p['y1_series']) + [p['y2_series']],
+    'single_axis_chart': lambda df, p: [p['x_series']] + _as_list(p['y1_series']),
+    'single_axis_chart2': lambda df, p: (
+        [p['x_series']] + _as_list(p['y_series']) + _as_list(p.get('confidence_interals') or None)),
+    'hodl_waves_chart': lambda df, p: ['date', 'PriceUSD'] + [
+        col for col in df.columns if col.startswith('utxo_{}_'.format(p['version']))],
+    'miner_herf_chart': lambda df, p: [p['pivot'], 'days_since_coinbase', 'herfindal_index'],
+}
+
+# Keyword arguments that do not change the figure. The cache builds with show=False and no save_file, and writes
+# save_file itself from the cached figure so hits write it too.
+IGNORED_KWARGS = {'show', 'save_file'}
+
+# Chart code whose changes invalidate cached figures, including helpers the chart functions call
+SOURCE_FILES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), x)
+                for x in ['chart_utils.py', 'analysis_utils.py']]
+_source_digests = {}
+
+def fingerprint_frame(df, columns=None):
+    """
+        Fast content hash of a dataframe's columns
+
+        Arguments:
+        df (dataframe): Pandas dataframe
+        columns (list): Columns to hash, default all
+
+        Returns:
+            Hex digest covering column names, dtypes and values in row order
+
+        """
+    columns = list(df.columns) if columns is None else list(dict.fromkeys(columns))
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(json.dumps([[str(col), str(df[col].dtype)] for col in columns]).encode())
+    digest.update(pd.util.hash_pandas_object(df[columns], index=False).values.tobytes())
+    return digest.hexdigest()
+
+def source_digest(paths=SOURCE_FILES):
+    ''' Hash of the chart source files, re-read only when a file's modification time changes '''
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        mtime = os.path.getmtime(path)
+        if _source_digests.get(path, (None,))[0] != mtime:
+            with open(path, 'rb') as f:
+                _source_digests[path] = (mtime, hashlib.blake2b(f.read(), digest_size=16).hexdigest())
+        digest.update(_source_digests[path][1].encode())
+    return digest.hexdigest()
+
+def bind_arguments(func, df, args, kwargs):
+    ''' Arguments after the dataframe by parameter name, with defaults filled in and **kwargs flattened '''
+    bound = inspect.signature(getattr(func, '__wrapped__', func)).bind(df, *args, **kwargs)
+    bound.apply_defaults()
+    params = {}
+    for name, value in list(bound.arguments.items())[1:]:
+        kind = bound.signature.parameters[name].kind
+        if kind == inspect.Parameter.VAR_KEYWORD:
+            params.update(value)
+        elif kind == inspect.Parameter.VAR_POSITIONAL:
+            params[name] = list(value)
+        else:
+            params[name] = value
+    return params
+
+def _build_figure(func, df, args, kwargs):
+    ''' func(df, *args, **kwargs) with show=False and save_file=None, however the caller passed them '''
+    signature = inspect.signature(func)
+    bound = signature.bind(df, *args, **{k: v for k, v in kwargs.items() if k != 'save_file'})
+    extra = {}
+    for name, value in [('show', False), ('save_file', None)]:
+        if name in signature.parameters:
+            bound.arguments[name] = value
+        elif name == 'show':
+            extra[name] = value
+    return func(*bound.args, **dict(bound.kwargs, **extra))
+
+def figure_key(func, df, args, kwargs):
+    ''' Cache key from the chart code, the columns the chart uses and its bound, defaulted arguments '''
+    name = func.__name__
+    params = bind_arguments(func, df, args, kwargs)
+    try:
+        columns = CHART_COLUMNS[name](df, params) if name in CHART_COLUMNS else None
+    except KeyError:
+        columns = None
+    params = {k: v for k, v in params.items() if k not in IGNORED_KWARGS}
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update('{}.{}'.format(func.__module__, name).encode())
+    code = getattr(getattr(func, '__wrapped__', func), '__code__', None)
+    if code is not None:
+        digest.update(code.co_code)
+        digest.update(repr(code.co_consts).encode())
+    digest.update(source_digest().encode())
+    digest.update(json.dumps(params, sort_keys=True, default=repr).encode())
+    digest.update(fingerprint_frame(df, columns).encode())
+    return digest.hexdigest()
+
+class FigureCache:
+    """
+        LRU cache of Plotly figures keyed on the data they plot and the arguments they were built with
+
+        Built figures are kept in memory and never handed out: get_figure returns a fresh copy built from the cached
+        figure's dict (a few tens of ms, well under a rebuild) that callers may change freely, and get_json returns
+        the canonical serialized figure, produced once per entry. A save_file argument is written from the cached
+        figure on hits as well as misses.
+
+        Arguments:
+        max_entries (int): Figures kept in memory
+        disk_dir (string): Optional directory to also keep figure JSON on disk across kernel restarts
+        disk_max_bytes (int): Size cap for disk_dir; least recently used files are removed above it
+
+        """
+    def __init__(self, max_entries=64, disk_dir=None, disk_max_bytes=512 * 1024 ** 2):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        # key -> [figure, figure dict, figure JSON]; the dict and JSON are None until first needed
+        self._memory = collections.OrderedDict()
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, '{}.json'.format(key))
+
+    def _remember(self, key, figure, figure_json=None):
+        entry = self._memory[key] = [figure, None, figure_json]
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+        return entry
+
+    def _write_disk(self, key, figure_json):
+        with open(self._disk_path(key), 'w') as f:
+            f.write(figure_json)
+        entries = [os.path.join(self.disk_dir, x) for x in os.listdir(self.disk_dir) if x.endswith('.json')]
+        entries = sorted(entries, key=os.path.getmtime)
+        total = sum(os.path.getsize(x) for x in entries)
+        for path in entries:
+            if total <= self.disk_max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def _lookup(self, key, func, df, args, kwargs):
+        with self._lock:
+            if key in self._memory:
+                self.hits += 1
+                self._memory.move_to_end(key)
+                return self._memory[key]
+            if self.disk_dir and os.path.exists(self._disk_path(key)):
+                with open(self._disk_path(key)) as f:
+                    figure_json = f.read()
+                os.utime(self._disk_path(key))
+                self.disk_hits += 1
+                return self._remember(key, pio.from_json(figure_json), figure_json)
+            self.misses += 1
+
+        figure = _build_figure(func, df, args, kwargs)
+        figure_json = figure.to_json() if self.disk_dir else None
+        with self._lock:
+            if self.disk_dir:
+                self._write_disk(key, figure_json)
+            return self._remember(key, figure, figure_json)
+
+    def _entry(self, func, df, args, kwargs):
+        entry = self._lookup(figure_key(func, df, args, kwargs), func, df, args, kwargs)
+        save_file = bind_arguments(func, df, args, kwargs).get('save_file')
+        if save_file:
+            plotly.offline.plot(entry[0], filename=save_file)
+        return entry
+
+    def get_figure(self, func, df, *args, **kwargs):
+        """
+            Plotly figure for func(df, *args, **kwargs), building it only on a cache miss
+
+            Returns:
+                A new figure on every call, so changing it does not affect later hits or get_json
+
+            """
+        entry = self._entry(func, df, args, kwargs)
+        if entry[1] is None:
+            entry[1] = entry[0].to_dict()
+        return go.Figure(entry[1])
+
+    def get_json(self, func, df, *args, **kwargs):
+        ''' Serialized figure for func(df, *args, **kwargs), e.g. to send to a browser; serialized once per entry '''
+        entry = self._entry(func, df, args, kwargs)
+        if entry[2] is None:
+            entry[2] = entry[0].to_json()
+        return entry[2]
+
+    def stats(self):
+        ''' Hit and miss counters for tuning max_entries and disk_max_bytes '''
+        with self._lock:
+            disk_bytes = 0
+            if self.disk_dir:
+                disk_bytes = sum(os.path.getsize(os.path.join(self.disk_dir, x))
+                                 for x in os.listdir(self.disk_dir) if x.endswith('.json'))
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'hits': self.hits, 'disk_hits': self.disk_hits, 'misses': self.misses,
+                'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+                'entries': len(self._memory), 'disk_bytes': disk_bytes,
+            }
+
+    def clear(self, disk=False):
+        with self._lock:
+            self._memory.clear()
+            if disk and self.disk_dir:
+                for x in os.listdir(self.disk_dir):
+                    if x.endswith('.json'):
+                        os.remove(os.path.join(self.disk_dir, x))
+
+default_cache = FigureCache()
+
+def cached_figure(func, df, *args, **kwargs):
+    ''' Figure from the default cache, e.g. cached_figure(chart_utils.hodl_waves_chart, df) '''
+    return default_cache.get_figure(func, df, *args, **kwargs)
@@ -0,0 +1,298 @@
+import argparse
+import asyncio
+import glob
+import json
+import logging
+import os
+import urllib.parse
+
+import numpy as np
+import pandas as pd
+
+import chart_utils
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+DATE_COLUMNS = ['date', 'metric_date', 'month', 'first_seen']
+RESOLUTIONS = {'W': 'week', 'M': 'month', 'Y': 'year'}
+HODL_WAVE_BANDS = [
+    ('under_1d', '<1d'), ('1d_1w', '1d-1w'), ('1w_1m', '1w-1m'), ('1m_3m', '1m-3m'), ('3m_6m', '3m-6m'),
+    ('6m_12m', '6m-12m'), ('12m_18m', '12m-18m'), ('18m_24m', '18m-2y'), ('2y_3y', '2y-3y'), ('3y_5y', '3y-5y'),
+    ('5y_8y', '5y-8y'), ('greater_8y', '>8y')]
+KEEPALIVE_SECONDS = 15
+
+def _column_lists(df):
+    ''' Dict of column name to JSON-safe list, with missing values as null '''
+    return {col: df[col].astype(object).where(df[col].notna(), None).tolist() for col in df.columns}
+
+class Dataset:
+    ''' One data/*.csv file, loaded once, sorted by its date column and reloaded when the file changes '''
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.mtime = None
+        self.df = None
+        self.date_col = None
+        self.views = {}
+        self.load()
+
+    def read(self):
+        ''' Read and sort the file without touching the served state; safe to run in a worker thread '''
+        mtime = os.path.getmtime(self.path)
+        df = pd.read_csv(self.path)
+        date_col = next((col for col in DATE_COLUMNS if col in df.columns), None)
+        if date_col:
+            df = df.sort_values(date_col, kind='stable').reset_index(drop=True)
+        return mtime, df, date_col
+
+    def swap(self, mtime, df, date_col):
+        ''' Serve a freshly read frame and return the rows that are new since the previous one '''
+        previous = self.df
+        self.mtime, self.df, self.date_col, self.views = mtime, df, date_col, {}
+        if previous is None or not date_col:
+            return df.iloc[0:0]
+        return df.loc[df[date_col] > previous[date_col].max()]
+
+    def load(self):
+        ''' (Re)read the file and return the rows that are new since the last load '''
+        return self.swap(*self.read())
+
+    def changed(self):
+        return os.path.getmtime(self.path) != self.mtime
+
+    def select(self, columns=None, start=None, end=None):
+        df = self.df
+        if self.date_col:
+            if start:
+                df = df.loc[df[self.date_col] >= start]
+            if end:
+                df = df.loc[df[self.date_col] <= end]
+        if columns:
+            missing = [col for col in columns if col not in df.columns]
+            if missing:
+                raise KeyError('Unknown columns for {}: {}'.format(self.name, ', '.join(missing)))
+            df = df[([self.date_col] if self.date_col and self.date_col not in columns else []) + columns]
+        return df
+
+def downsample(df, date_col, resolution=None, max_points=None):
+    """
+        Reduce a time series for display
+
+        Arguments:
+        df (dataframe): Pandas dataframe sorted by date_col
+        date_col (string): '%Y-%m-%d' date column, or None for datasets without one
+        resolution (string): 'W', 'M' or 'Y' to average numeric columns per week, month or year
+        max_points (int): Average consecutive rows into at most this many points
+
+        Returns:
+            Pandas dataframe with numeric columns averaged and other columns, including the date, taken from the
+            first row of each group
+
+        """
+    if len(df) == 0 or (not resolution and not max_points):
+        return df
+    if resolution:
+        if resolution not in RESOLUTIONS:
+            raise ValueError('resolution must be one of {}'.format(', '.join(RESOLUTIONS)))
+        if not date_col:
+            raise ValueError('resolution needs a dataset with a date column; use max_points')
+        days = pd.to_datetime(df[date_col].astype(str).str[:10]).values.astype('datetime64[D]')
+        if resolution == 'W':
+            # Weeks starting Sunday, as analysis_utils.get_extra_datetime_cols
+            groups = days - ((days.view('int64') + 4) % 7).astype('timedelta64[D]')
+        else:
+            groups = days.astype('datetime64[{}]'.format(resolution)).astype('datetime64[D]')
+    else:
+        groups = np.arange(len(df)) * max_points // len(df)
+    numeric = set(df.select_dtypes('number').columns)
+    out = df.groupby(groups, sort=True).agg({col: 'mean' if col in numeric else 'first' for col in df.columns})
+    return out.reset_index(drop=True)
+
+class ChartServer:
+    """
+        asyncio HTTP service serving chart-ready series from the data/ datasets held once in memory
+
+        Endpoints (GET, JSON):
+            /datasets
+            /series?dataset=&columns=a,b&start=&end=&resolution=W|M|Y&max_points=
+            /hodl_waves?version=value|count|count_filter&start=&end=&resolution=&max_points=
+            /heatmap?type=sats|usd&start=&end=
+            /stream?dataset=  Server-sent events, one message with only the new rows whenever the file gains rows
+
+        Arguments:
+        data_dir (string): Directory of CSV datasets
+        poll_seconds (float): How often to check the files for new rows
+
+        """
+    def __init__(self, data_dir=DATA_DIR, poll_seconds=5):
+        self.poll_seconds = poll_seconds
+        self.datasets = {}
+        for path in sorted(glob.glob(os.path.join(data_dir, '*.csv'))):
+            dataset = Dataset(path)
+            self.datasets[dataset.name] = dataset
+        self.subscribers = {name: set() for name in self.datasets}
+        self.streams = set()
+
+    def dataset(self, name):
+        if name not in self.datasets:
+            raise KeyError('Unknown dataset {}'.format(name))
+        return self.datasets[name]
+
+    def list_datasets(self, params):
+        return [{
+            'name': d.name, 'rows': len(d.df), 'date_column': d.date_col, 'columns': list(d.df.columns),
+            'start': d.df[d.date_col].iloc[0] if d.date_col and len(d.df) else None,
+            'end': d.df[d.date_col].iloc[-1] if d.date_col and len(d.df) else None,
+        } for d in self.datasets.values()]
+
+    def series(self, params):
+        dataset = self.dataset(params.get('dataset'))
+        columns = [x for x in params.get('columns', '').split(',') if x]
+        df = dataset.select(columns, params.get('start'), params.get('end'))
+        df = downsample(df, dataset.date_col, params.get('resolution'), int(params.get('max_points', 0)) or None)
+        return _column_lists(df)
+
+    def hodl_waves(self, params):
+        ''' Band shares of the total in percent, as the stacked groupnorm in chart_utils.hodl_waves_chart '''
+        dataset = self.dataset(params.get('dataset', '03_hodl_waves_real_cap'))
+        version = params.get('version', 'value')
+        bands = ['utxo_{}_{}'.format(version, suffix) for suffix, _ in HODL_WAVE_BANDS]
+        price = 'price_usd' if 'price_usd' in dataset.df.columns else 'PriceUSD'
+        key = ('hodl_waves', version)
+        if key not in dataset.views:
+            df = dataset.df[[dataset.date_col] + bands + [price]].copy()
+            totals = df[bands].sum(axis=1).replace(0, np.nan)
+            df[bands] = df[bands].div(totals, axis=0) * 100
+            dataset.views[key] = df.rename(columns=dict(
+                [(band, label) for band, (_, label) in zip(bands, HODL_WAVE_BANDS)] + [(price, 'PriceUSD')]))
+        df = dataset.views[key]
+        if params.get('start'):
+            df = df.loc[df[dataset.date_col] >= params['start']]
+        if params.get('end'):
+            df = df.loc[df[dataset.date_col] <= params['end']]
+        df = downsample(df, dataset.date_col, params.get('resolution'), int(params.get('max_points', 0)) or None)
+        return _column_lists(df)
+
+    def heatmap(self, params):
+        ''' Share of transactions per fee bucket per month, highest bucket first, as block_space_price_heatmap '''
+        dataset = self.dataset(params.get('dataset', '04_block_space_price_heat'))
+        fee_type = params.get('type', 'sats')
+        key = ('heatmap', fee_type)
+        if key not in dataset.views:
+            df = dataset.df.loc[dataset.df['bucket_type'] == fee_type]
+            months = list(df['month'].unique())
+            aggregate_data = df.groupby(['month', 'bucket']).sum()[['tx_count']]
+            counts, bins = chart_utils.block_space_heatmap_data(aggregate_data, months, type=fee_type)
+            with np.errstate(invalid='ignore'):
+                shares = counts / counts.sum(axis=0)
+            dataset.views[key] = (months, bins, shares)
+        months, bins, shares = dataset.views[key]
+        keep = [i for i, month in enumerate(months)
+                if (not params.get('start') or month >= params['start'])
+                and (not params.get('end') or month <= params['end'])]
+        shares = np.where(np.isnan(shares[:, keep]), None, np.round(shares[:, keep], 6).astype(object))
+        return {'months': [months[i] for i in keep], 'bins': bins, 'share': shares.tolist()}
+
+    async def watch(self):
+        ''' Reload changed files and push only their new rows to stream subscribers '''
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            for name, dataset in self.datasets.items():
+                try:
+                    if not dataset.changed():
+                        continue
+                    # Parse off the event loop so viewers are not stalled while a file is re-read
+                    new_rows = dataset.swap(*await asyncio.to_thread(dataset.read))
+                except (OSError, pd.errors.ParserError) as e:
+                    logger.warning('Could not reload %s: %s', name, e)
+                    continue
+                if len(new_rows) and self.subscribers[name]:
+                    message = json.dumps({'dataset': name, 'rows': _column_lists(new_rows)})
+                    for queue in self.subscribers[name]:
+                        queue.put_nowait(message)
+
+    async def stream(self, params, writer):
+        dataset = self.dataset(params.get('dataset'))
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                     b'Access-Control-Allow-Origin: *\r\nConnection: keep-alive\r\n\r\n')
+        await writer.drain()
+        queue = asyncio.Queue()
+        self.subscribers[dataset.name].add(queue)
+        self.streams.add(asyncio.current_task())
+        try:
+            while True:
+                try:
+                    message = await asyncio.wait_for(queue.get(), KEEPALIVE_SECONDS)
+                    if message is None:
+                        break
+                    writer.write('data: {}\n\n'.format(message).encode())
+                except asyncio.TimeoutError:
+                    writer.write(b': keepalive\n\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.subscribers[dataset.name].discard(queue)
+            self.streams.discard(asyncio.current_task())
+
+    async def handle(self, reader, writer):
+        routes = {
+            '/datasets': self.list_datasets, '/series': self.series,
+            '/hodl_waves': self.hodl_waves, '/heatmap': self.heatmap,
+        }
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            if len(request_line) < 2 or request_line[0] != 'GET':
+                return await self.respond(writer, 405, {'error': 'Only GET is supported'})
+            url = urllib.parse.urlsplit(request_line[1])
+            params = dict(urllib.parse.parse_qsl(url.query))
+            if url.path == '/stream':
+                return await self.stream(params, writer)
+            if url.path not in routes:
+                return await self.respond(writer, 404, {'error': 'Unknown path {}'.format(url.path)})
+            await self.respond(writer, 200, routes[url.path](params))
+        except (KeyError, ValueError) as e:
+            await self.respond(writer, 400, {'error': str(e).strip('"\'')})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body):
+        payload = json.dumps(body).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n'.format(
+                         status, reason, len(payload)).encode() + payload)
+        await writer.drain()
+
+    async def serve(self, host='127.0.0.1', port=8050):
+        server = await asyncio.start_server(self.handle, host, port)
+        watcher = asyncio.ensure_future(self.watch())
+        logger.info('Serving %d datasets on http://%s:%d', len(self.datasets), host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            watcher.cancel()
+            # End open streams with a sentinel so they finish normally before the loop shuts down
+            for queues in self.subscribers.values():
+                for queue in queues:
+                    queue.put_nowait(None)
+            await asyncio.gather(*self.streams, return_exceptions=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve chart-ready series from data/ over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8050)
+    parser.add_argument('--data-dir', default=DATA_DIR)
+    parser.add_argument('--poll', type=float, default=5, help='Seconds between checks for new rows')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(ChartServer(args.data_dir, args.poll).serve(args.host, args.port))
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
+import collections
+import concurrent.futures
 import datetime
+import itertools
+import subprocess
 import numpy as np
 
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 
 import matplotlib as mpl
+import matplotlib.animation
 import matplotlib.pyplot as plt
 
 import analysis_utils
+import profiling_utils
 
 def two_axis_chart(df, x_series, y1_series, y2_series, **kwargs):
     """
@@ -30,6 +36,7 @@ def two_axis_chart(df, x_series, y1_series, y2_series, **kwargs):
         y1_lower_thresh (float): Lower threshold for highlighting regions with extreme values for Y1 series
         thresh_inverse (bool): When true, high values of a ratio metric are highlighted green. When false, high values
             indicate poor fundamentals and are highlighted red. Inverse logic for lower threshold.
+        show (bool): When false, return the figure instead of showing it. Default is True.
 
         Returns:
             Plotly figure
@@ -168,8 +175,12 @@ def two_axis_chart(df, x_series, y1_series, y2_series, **kwargs):
 
     if kwargs.get('save_file', None):
         import plotly
-        plotly.offline.plot(fig, filename=kwargs.get('save_file'))
-    return fig.show()
+        with profiling_utils.span('two_axis_chart.save', figure=fig):
+            plotly.offline.plot(fig, filename=kwargs.get('save_file'))
+    if not kwargs.get('show', True):
+        return fig
+    with profiling_utils.span('two_axis_chart.show', figure=fig):
+        return fig.show()
 
 def single_axis_chart(df, x_series, y1_series, **kwargs):
     """
@@ -189,6 +200,7 @@ def single_axis_chart(df, x_series, y1_series, **kwargs):
         y1_lower_thresh (float): Lower threshold for highlighting regions with extreme values for Y1 series
         thresh_inverse (bool): When true, high values of a ratio metric are highlighted green. When false, high values
             indicate poor fundamentals and are highlighted red. Inverse logic for lower threshold.
+        show (bool): When false, return the figure instead of showing it. Default is True.
 
         Returns:
             Plotly figure
@@ -268,7 +280,10 @@ def single_axis_chart(df, x_series, y1_series, **kwargs):
         showgrid=False
     )
 
-    return fig.show()
+    if not kwargs.get('show', True):
+        return fig
+    with profiling_utils.span('single_axis_chart.show', figure=fig):
+        return fig.show()
 
 def single_axis_chart2(df, x_series, y_series, **kwargs):
     fig = make_subplots(
@@ -427,7 +442,7 @@ def create_highlighted_region_shapes(date_regions, fillcolor='LightSalmon'):
         )
     return shapes
 
-def hodl_waves_chart(df, version='value', save_file=None):
+def hodl_waves_chart(df, version='value', save_file=None, show=True):
     """
             Plot a two axis chart using Plotly library
 
@@ -435,6 +450,8 @@ def hodl_waves_chart(df, version='value', save_file=None):
             df (dataframe): Pandas dataframe containing HODL waves dataframe from 02_HODLWaves.ipynb notebook
             version: Can plot HODL waves by TXO value ('value), by total count of TXO ('count'),
                      and by TXO with balance > 0.01 BTC ('count_filter')
+            save_file (str): Optional HTML file to write the chart to
+            show (bool): When false, return the figure instead of showing it
 
             Returns:
                 Plotly figure
@@ -626,10 +643,12 @@ def hodl_waves_chart(df, version='value', save_file=None):
 
     if save_file:
         import plotly
-        plotly.offline.plot(fig, filename=save_file)
-    return fig.show()
-
-    return fig.show()
+        with profiling_utils.span('hodl_waves_chart.save', figure=fig):
+            plotly.offline.plot(fig, filename=save_file)
+    if not show:
+        return fig
+    with profiling_utils.span('hodl_waves_chart.show', figure=fig):
+        return fig.show()
 
 def colorFader(c1, c2, mix=0):
     ''' Returns the midpoint between two colors '''
@@ -637,6 +656,28 @@ def colorFader(c1, c2, mix=0):
     c2 = np.array(mpl.colors.to_rgb(c2))
     return mpl.colors.to_hex((1 - mix) * c1 + mix * c2)
 
+def block_space_heatmap_data(aggregate_data, date_series, type='sats'):
+    """
+            Build the (fee bucket x date) transaction count matrix behind block_space_price_heatmap
+
+            Arguments:
+                aggregate_data (dataframe): Pandas dataframe with bucket counts over some time aggregation
+                date_series (list): List of dates to plot
+                type (str): Fee type: 'sats' or 'usd'
+
+            Returns:
+                Numpy array of tx counts with the highest fee bucket in the first row, and the reversed bucket labels
+
+            """
+    if type == 'sats':
+        bins = analysis_utils.SATS_FEE_BINS
+    elif type == 'usd':
+        bins = analysis_utils.USD_FEE_BINS
+    bins_reversed = [x for x in reversed(bins)]
+    counts = aggregate_data['tx_count'].unstack(fill_value=0)
+    heatmap_data = counts.reindex(index=list(date_series), columns=bins_reversed, fill_value=0).T
+    return heatmap_data.to_numpy(dtype=np.float64), bins_reversed
+
 def block_space_price_heatmap(aggregate_data, date_series, price_data, type='sats', **kwargs):
     """
             Plot a block space price histogram
@@ -648,28 +689,28 @@ def block_space_price_heatmap(aggregate_data, date_series, price_data, type='sat
                     as aggregate)data
                 type (str): Fee type: 'sats' or 'usd'
 
+            Keyword arguments:
+                data_source (str): Data source credited on the chart
+                save_file (str): Image file to write, default 'img/04_block_space_dist_{type}.png'. None to skip.
+                show (bool): When false, return the matplotlib figure instead of showing it. Default is True.
+
             Returns:
                 Matplotlib histogram plot
 
             """
     if type == 'sats':
-        bins = analysis_utils.SATS_FEE_BINS
         volume = 'transaction_volume_btc'
     elif type == 'usd':
-        bins = analysis_utils.USD_FEE_BINS
         volume = 'transaction_volume_usd'
-    heatmap_data = np.zeros((len(bins), len(date_series)))
-    bins_reversed = [x for x in reversed(bins)]
-    for month_index, month_name in enumerate(date_series):
-        for bin_index, bin_name in enumerate(bins_reversed):
-            heatmap_data[bin_index, month_index] = aggregate_data['tx_count'].get(month_name, {}).get(bin_name, 0)
+    heatmap_data, bins_reversed = block_space_heatmap_data(aggregate_data, date_series, type=type)
 
+    # Before the figure is created so its background is dark too, not only the artists added after
+    plt.style.use('dark_background')
     fig = plt.figure(
         figsize=[12, 6],
         clear=True,
         tight_layout=True
     )
-    plt.style.use('dark_background')
 
     ax = plt.imshow(
         heatmap_data / heatmap_data.sum(axis=0),
@@ -724,42 +765,273 @@ def block_space_price_heatmap(aggregate_data, date_series, price_data, type='sat
     ax2.set_ylabel(volume, fontsize=18)
     ax2.set_yscale("log")
     ax2.set_yticklabels(['{:,.0f}'.format(x) for x in ax2.get_yticks()])
-    plt.savefig('img/04_block_space_dist_{}.png'.format(type))
 
-    return plt.show()
+    save_file = kwargs.get('save_file', 'img/04_block_space_dist_{}.png'.format(type))
+    if save_file:
+        with profiling_utils.span('block_space_price_heatmap.savefig', figure=fig):
+            plt.savefig(save_file)
+
+    if not kwargs.get('show', True):
+        return fig
+    with profiling_utils.span('block_space_price_heatmap.show', figure=fig):
+        return plt.show()
 
-def miner_herf_chart(df, pivot='month_string', **kwargs):
+def _block_space_animation_figure(fig, heatmap_data, bins_reversed, date_series, volumes, type='sats',
+                                  data_source=None):
     """
-        Plot a two axis chart using Plotly library
+            Draw the static parts of the block space price animation once
+
+            Returns:
+                Function taking a date index, updating the heatmap, price line and date label to that date and
+                returning the changed artists
+            """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shares = heatmap_data / heatmap_data.sum(axis=0)
+    display = np.full(shares.shape, np.nan)
+    filled = [0]
+
+    with plt.style.context('dark_background'):
+        ax = fig.add_subplot(1, 1, 1)
+        image = ax.imshow(display, cmap='hot', interpolation=None, aspect='auto', vmin=0, vmax=np.nanmax(shares))
+        ax.set_xticks([y for y, x in enumerate(date_series) if "January" in x])
+        ax.set_xticklabels([x[-4:] for y, x in enumerate(date_series) if "January" in x])
+        ax.set_yticks([y for y, x in enumerate(bins_reversed)])
+        ax.set_yticklabels(bins_reversed)
+        ax.set_ylabel("Fee Rate (Sats/vByte)" if type == 'sats' else "Fee Rate (USD/vByte)", fontsize=18)
+        ax.set_xlabel("Date", fontsize=18)
+        ax.set_title("Bitcoin Block Space Price Distribution Over Time", fontsize=26)
+        ax.text(1, -0.1, "Chart by: @typerbole", transform=ax.transAxes,
+                horizontalalignment='center', verticalalignment='center', fontsize=16)
+        if data_source:
+            ax.text(0, -0.1, "Data: {}".format(data_source), transform=ax.transAxes,
+                    horizontalalignment='center', verticalalignment='center', fontsize=12)
+        date_label = ax.text(0.02, 0.95, '', transform=ax.transAxes, color='white', fontsize=16, animated=True)
+
+        fig.colorbar(image, ax=ax, pad=0.17)
+        ax2 = ax.twinx()
+        # Overlays on the heatmap are redrawn each frame so the blitted image does not cover them
+        overlays = []
+        if "August 2017" in date_series:
+            segwit = list(date_series).index("August 2017")
+            overlays = [
+                ax.axvline(segwit, color='white', linestyle='dashed', linewidth=1, animated=True),
+                ax.text(segwit, len(bins_reversed) / 2, 'July 2017 SegWit Activation',
+                        horizontalalignment='right', color='white', animated=True)]
+        price_line, = ax2.plot([], [], animated=True)
+        ax2.set_xlim(ax.get_xlim())
+        ax2.set_yscale("log")
+        if np.isfinite(volumes).any() and np.nanmax(volumes) > 0:
+            ax2.set_ylim(np.nanmin(volumes[volumes > 0]), np.nanmax(volumes))
+        ax2.set_ylabel('transaction_volume_btc' if type == 'sats' else 'transaction_volume_usd', fontsize=18)
+        image.set_animated(True)
+        fig.tight_layout()
+
+    def update(index):
+        if index + 1 < filled[0]:
+            display[:, index + 1:] = np.nan
+        else:
+            display[:, filled[0]:index + 1] = shares[:, filled[0]:index + 1]
+        filled[0] = index + 1
+        image.set_data(display)
+        price_line.set_data(np.arange(index + 1), volumes[:index + 1])
+        date_label.set_text(date_series[index])
+        return [image] + overlays + [price_line, date_label]
+
+    return update
+
+def _blitted_frames(fig, update, indexes):
+    ''' Draw the static figure once, then yield an RGBA PIL image per date index redrawing only the changed artists '''
+    from PIL import Image
+    canvas = fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    for index in indexes:
+        canvas.restore_region(background)
+        for artist in update(index):
+            artist.axes.draw_artist(artist)
+        yield Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1).copy()
+
+# Figure and update function of a block space animation worker process, built once by _init_block_space_worker
+_animation_worker = None
+
+def _init_block_space_worker(figure_args, figsize, dpi):
+    global _animation_worker
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = mpl.figure.Figure(figsize=figsize, dpi=dpi, facecolor='black')
+    FigureCanvasAgg(fig)
+    _animation_worker = (fig, _block_space_animation_figure(fig, *figure_args))
+
+def _render_block_space_frames(indexes, palette):
+    """
+            Worker: draw a run of animation frames and return them as raw bytes
+
+            Frames are returned as (mode, size, bytes, palette). With palette set they are quantized to 256 colors
+            here, which is most of the cost of writing a GIF, so the parent process only has to encode them.
+            """
+    fig, update = _animation_worker
+    frames = []
+    for image in _blitted_frames(fig, update, indexes):
+        if palette:
+            image = _gif_frame(image)
+            frames.append(('P', image.size, image.tobytes(), image.getpalette()))
+        else:
+            image = image.convert('RGB')
+            frames.append(('RGB', image.size, image.tobytes(), None))
+    return frames
+
+def _parallel_block_space_frames(indexes, figure_args, figsize, dpi, workers, palette, run_rows=16):
+    ''' PIL images for indexes, drawn in worker processes and yielded in order with a bounded number in flight '''
+    from PIL import Image
+    runs = [indexes[i:i + run_rows] for i in range(0, len(indexes), run_rows)]
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_block_space_worker,
+            initargs=(figure_args, figsize, dpi)) as pool:
+        pending = collections.deque()
+        for run in runs:
+            pending.append(pool.submit(_render_block_space_frames, run, palette))
+            if len(pending) < 2 * workers:
+                continue
+            for frame in pending.popleft().result():
+                yield _frame_image(Image, frame)
+        while pending:
+            for frame in pending.popleft().result():
+                yield _frame_image(Image, frame)
+
+def _gif_frame(image):
+    ''' Quantize a frame to a 256 color palette, the same way in this process and in workers '''
+    from PIL import Image
+    return image.convert('RGB').quantize(256, method=Image.Quantize.FASTOCTREE)
+
+def _frame_image(Image, frame):
+    mode, size, data, palette = frame
+    image = Image.frombytes(mode, size, data)
+    if palette:
+        image.putpalette(palette)
+    return image
+
+def _encode_frames(images, save_file, fps):
+    ''' Encode PIL images into a GIF with Pillow, or any other video format by piping raw frames to ffmpeg '''
+    images = iter(images)
+    first = next(images)
+    if save_file.endswith('.gif'):
+        first.save(save_file, save_all=True, append_images=images, duration=int(1000 / fps), loop=0)
+        return
+    width, height = first.size
+    ffmpeg = subprocess.Popen([
+        mpl.rcParams['animation.ffmpeg_path'], '-y', '-loglevel', 'error', '-f', 'rawvideo', '-pix_fmt', 'rgba',
+        '-s', '{}x{}'.format(width, height), '-r', str(fps), '-i', '-',
+        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', save_file
+    ], stdin=subprocess.PIPE)
+    try:
+        for image in itertools.chain([first], images):
+            ffmpeg.stdin.write(image.convert('RGBA').tobytes())
+    finally:
+        ffmpeg.stdin.close()
+        if ffmpeg.wait():
+            raise RuntimeError('ffmpeg failed writing {}'.format(save_file))
+
+def block_space_price_animation(aggregate_data, date_series, price_data, type='sats', **kwargs):
+    """
+            Animate the block space price heatmap filling in date by date, with the transaction volume line
+
+            The heatmap cube is built once and the axes, colorbar and labels are drawn once; each frame only redraws
+            the heatmap image, price line and date label (blitting). With workers > 1 the frames are drawn (and for
+            GIFs quantized) in parallel processes and streamed back as raw bytes to be encoded into save_file.
+            Each worker process takes about a second to start and draw its figure, and a blitted frame takes under
+            20ms, so workers only pay off with several free cores and long animations, e.g. daily resolution.
+
+            Arguments:
+                aggregate_data (dataframe): Pandas dataframe with bucket counts over some time aggregation
+                date_series (list): List of dates to plot
+                price_data (dataframe): Pandas dataframe with mean prices and TX volume over the same time aggregation
+                    as aggregate_data
+                type (str): Fee type: 'sats' or 'usd'
+
+            Keyword arguments:
+                data_source (str): Data source credited on the chart
+                save_file (str): '.gif' (Pillow) or other video file (ffmpeg) to write. Required with workers.
+                fps (int): Frames per second. Default is 12.
+                step (int): Dates to advance per frame. Default is 1.
+                workers (int): Processes drawing frames in parallel. Default is None, drawing in this process,
+                    which is faster for short animations.
+                dpi (int): Frame resolution. Default is 80.
+                show (bool): When false, return without showing the animation. Default is True.
+
+            Returns:
+                Matplotlib FuncAnimation, or the path of the encoded file when workers is set
+
+            """
+    volume = 'transaction_volume_btc' if type == 'sats' else 'transaction_volume_usd'
+    date_series = list(date_series)
+    heatmap_data, bins_reversed = block_space_heatmap_data(aggregate_data, date_series, type=type)
+    volumes = np.array([price_data.get(volume).get(x) for x in date_series], dtype=np.float64)
+    figure_args = (heatmap_data, bins_reversed, date_series, volumes, type, kwargs.get('data_source'))
+
+    fps = kwargs.get('fps', 12)
+    dpi = kwargs.get('dpi', 80)
+    figsize = [12, 6]
+    save_file = kwargs.get('save_file')
+    indexes = list(range(0, len(date_series), kwargs.get('step', 1)))
+    if indexes[-1] != len(date_series) - 1:
+        indexes.append(len(date_series) - 1)
+
+    workers = kwargs.get('workers')
+    if workers and workers > 1:
+        if not save_file:
+            raise ValueError('save_file is required when rendering frames with workers')
+        frames = _parallel_block_space_frames(
+            indexes, figure_args, figsize, dpi, workers, palette=save_file.endswith('.gif'))
+        with profiling_utils.span('block_space_price_animation.save', rows=len(indexes)):
+            _encode_frames(frames, save_file, fps)
+        return save_file
+
+    fig = plt.figure(figsize=figsize, dpi=dpi, facecolor='black')
+    update = _block_space_animation_figure(fig, *figure_args)
+    if save_file:
+        frames = _blitted_frames(fig, update, indexes)
+        if save_file.endswith('.gif'):
+            frames = (_gif_frame(x) for x in frames)
+        with profiling_utils.span('block_space_price_animation.save', rows=len(indexes)):
+            _encode_frames(frames, save_file, fps)
+    animation = mpl.animation.FuncAnimation(
+        fig, update, frames=indexes, interval=1000 / fps, blit=True, repeat=False)
+    if not kwargs.get('show', True):
+        return animation
+    with profiling_utils.span('block_space_price_animation.show'):
+        plt.show()
+    return animation
+
+def event_aligned_chart(wide_df, **kwargs):
+    """
+        Plot curves aligned to days since an event using Plotly library
 
         Arguments:
-        df (dataframe): Pandas dataframe containing CoinMetrics community data
+        wide_df (dataframe): Pandas dataframe indexed by days since event with one column per curve, as returned
+            by analysis_utils.align_to_events
 
         Keyword arguments:
         title (string): Title for the plot
-        x_axis_title (string): Title for X axis, defaults to string from x_series
-        y1_series_axis_type (string): Left Y axis type. Default is 'log'. Other sane option: 'linear'
+        x_axis_title (string): Title for X axis
+        y1_series_title (string): Title for the Y axis
+        y1_series_axis_type (string): Left Y axis type. Default is 'linear'. Other sane option: 'log'
         y1_series_axis_range (list): Range for left Y axis. When axis type is log, range values represent powers of 10
 
         Returns:
             Plotly figure
 
         """
-    # Create figure with secondary y-axis
     fig = make_subplots(
         specs=[[{"secondary_y": False}]]
     )
 
-    curves = list(df[pivot].unique())
-
-    if kwargs.get('y1_series_title'):
-        y1_series_title = kwargs.get('y1_series_title')
+    y1_series_title = kwargs.get('y1_series_title', '')
+    x = wide_df.index.values
 
-    for curve in curves:
-        # First trace
-        curve_df = df.loc[df[pivot] == curve].reset_index(drop=True)
+    for curve in wide_df.columns:
+        y = wide_df[curve].values
+        present = ~np.isnan(y)
         fig.add_trace(
-            go.Scatter(x=curve_df['days_since_coinbase'], y=curve_df['herfindal_index'], name=curve),
+            go.Scatter(x=x[present], y=y[present], name=str(curve)),
             secondary_y=False
         )
 
@@ -788,8 +1060,41 @@ def miner_herf_chart(df, pivot='month_string', **kwargs):
     # Set y-axes titles
     fig.update_yaxes(
         title_text=y1_series_title, secondary_y=False, tickformat=kwargs.get('y1_series_axis_format', None),
-        type=kwargs.get('y1_series_axis_type', 'linear'), range=kwargs.get('y1_series_axis_range', [0, 1]),
+        type=kwargs.get('y1_series_axis_type', 'linear'), range=kwargs.get('y1_series_axis_range'),
         showgrid=False
     )
 
-    return fig.show()
\ No newline at end of file
+    return fig
+
+def miner_herf_chart(df, pivot='month_string', **kwargs):
+    """
+        Plot coinbase herfindahl curves by days since coinbase using Plotly library
+
+        Arguments:
+        df (dataframe): Pandas dataframe with 'days_since_coinbase' and 'herfindal_index' columns
+        pivot (string): Column name labelling each curve
+
+        Keyword arguments:
+        title (string): Title for the plot
+        x_axis_title (string): Title for X axis
+        y1_series_title (string): Title for the Y axis
+        y1_series_axis_type (string): Left Y axis type. Default is 'linear'. Other sane option: 'log'
+        y1_series_axis_range (list): Range for left Y axis, default [0, 1]. When axis type is log, range values
+            represent powers of 10
+        data_source (string): Data source credited on the chart
+        show (bool): When false, return the figure instead of showing it. Default is True.
+
+        Returns:
+            Plotly figure
+
+        """
+    wide_df = analysis_utils.align_to_events(
+        df, 'herfindal_index', curve_series=pivot, days_series='days_since_coinbase')
+
+    kwargs.setdefault('y1_series_axis_range', [0, 1])
+    fig = event_aligned_chart(wide_df, **kwargs)
+
+    if not kwargs.get('show', True):
+        return fig
+    with profiling_utils.span('miner_herf_chart.show', figure=fig):
+        return fig.show()
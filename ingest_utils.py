@@ -0,0 +1,184 @@
+import array
+import json
+
+import numpy as np
+import pandas as pd
+
+import analysis_utils
+
+TIME_KEYS = ('t', 'timestamp', 'time', 'date')
+CHUNK_CHARS = 1 << 20
+
+def iter_json_array(path, chunk_chars=CHUNK_CHARS):
+    """
+        Stream the elements of a top-level JSON array without loading the whole file
+
+        Arguments:
+        path (string): Path to a file containing a JSON array, e.g. a Glassnode export
+        chunk_chars (int): Characters read from the file at a time. Memory use is bounded by this plus the largest
+            single element.
+
+        Returns:
+            Generator of decoded array elements
+
+        """
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buffer = ''
+        pos = 0
+        eof = False
+        started = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+                pos += 1
+            if not started and pos < len(buffer):
+                if buffer[pos] != '[':
+                    raise ValueError('{} does not contain a JSON array'.format(path))
+                started = True
+                pos += 1
+                continue
+            if started and pos < len(buffer) and buffer[pos] == ']':
+                return
+            try:
+                if pos >= len(buffer):
+                    raise json.JSONDecodeError('Need more data', buffer, pos)
+                item, end = decoder.raw_decode(buffer, pos)
+                # A bare number at the end of the buffer may be cut short; only trust it once more data arrives
+                if end == len(buffer) and not eof:
+                    raise json.JSONDecodeError('Need more data', buffer, pos)
+            except json.JSONDecodeError:
+                # The closing ']' returns above, so reaching the end of the file here means the array never closed
+                if eof:
+                    raise ValueError('Truncated JSON array in {}'.format(path))
+                chunk = f.read(chunk_chars)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield item
+            pos = end
+
+def _epoch_seconds(value):
+    if isinstance(value, (int, float)):
+        # Some providers export milliseconds
+        return int(value // 1000) if value > 1e11 else int(value)
+    return int(np.datetime64(str(value).replace('Z', '').replace(' ', 'T')[:19], 's').astype(np.int64))
+
+def _flatten(row):
+    ''' Turn a {t, o: {...}} or {timestamp, value} row into (timestamp, {column: value}) '''
+    timestamp = None
+    values = {}
+    for key, value in row.items():
+        if timestamp is None and key in TIME_KEYS:
+            timestamp = value
+        elif isinstance(value, dict):
+            values.update(value)
+        else:
+            values[key] = value
+    if timestamp is None:
+        raise ValueError('Row has no timestamp key ({}): {}'.format(', '.join(TIME_KEYS), row))
+    return timestamp, values
+
+class _ColumnBuilder:
+    ''' Accumulate rows into growable typed arrays, falling back to a list for non-numeric columns '''
+    def __init__(self):
+        self.timestamps = array.array('q')
+        self.columns = {}
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def append(self, row):
+        timestamp, values = _flatten(row)
+        n_rows = len(self.timestamps)
+        self.timestamps.append(_epoch_seconds(timestamp))
+        for key, value in values.items():
+            column = self.columns.get(key)
+            if column is None:
+                column = self.columns[key] = array.array('d', [np.nan] * n_rows)
+            if isinstance(column, array.array):
+                if value is None:
+                    value = np.nan
+                elif not isinstance(value, (int, float)) or isinstance(value, bool):
+                    column = self.columns[key] = [None if np.isnan(x) else x for x in column]
+            column.append(value)
+        # Pad columns missing from this row
+        for key, column in self.columns.items():
+            if len(column) == n_rows:
+                column.append(np.nan if isinstance(column, array.array) else None)
+
+    def to_frame(self):
+        datetimes = pd.Series(pd.to_datetime(np.array(self.timestamps, dtype=np.int64), unit='s'))
+        df = pd.DataFrame({'datetime': datetimes, 'date': datetimes.dt.strftime('%Y-%m-%d')})
+        for key, column in self.columns.items():
+            df[key] = np.array(column, dtype=np.float64) if isinstance(column, array.array) else column
+        self.timestamps = array.array('q')
+        self.columns = {}
+        return df
+
+def iter_json_timeseries(path, chunk_rows=1000000, chunk_chars=CHUNK_CHARS):
+    """
+        Stream a JSON time-series export as dataframes of at most chunk_rows rows
+
+        Rows may be {'t': ..., 'o': {'binance': ..., 'bitfinex': ...}} (one column per nested key) or flat
+        {'timestamp': ..., 'value': ...}. Timestamps may be unix seconds, milliseconds or ISO strings.
+
+        Arguments:
+        path (string): Path to a JSON array file
+        chunk_rows (int): Maximum rows per yielded dataframe
+        chunk_chars (int): Characters read from the file at a time
+
+        Returns:
+            Generator of Pandas dataframes with 'datetime' and '%Y-%m-%d' 'date' columns followed by one column per
+            value key
+
+        """
+    builder = _ColumnBuilder()
+    for row in iter_json_array(path, chunk_chars):
+        builder.append(row)
+        if len(builder) >= chunk_rows:
+            yield builder.to_frame()
+    if len(builder):
+        yield builder.to_frame()
+
+def read_json_timeseries(path, extra_datetime_cols=False):
+    """
+        Load a JSON time-series export into a single dataframe, built once from typed column arrays
+
+        Arguments:
+        path (string): Path to a JSON array file, e.g. Glassnode's exchange balance or netflow exports
+        extra_datetime_cols (bool): When true, add analysis_utils.get_extra_datetime_cols columns
+
+        Returns:
+            Pandas dataframe
+
+        """
+    builder = _ColumnBuilder()
+    for row in iter_json_array(path):
+        builder.append(row)
+    df = builder.to_frame()
+    if extra_datetime_cols:
+        df = analysis_utils.get_extra_datetime_cols(df, 'datetime')
+    return df
+
+def iter_transaction_chunks(path, columns=('hash', 'block_timestamp', 'fee'), chunk_rows=1000000):
+    """
+        Stream a local transactions export (e.g. bitcoin-etl CSV) in chunks with a '%Y-%m-%d' 'date' column added
+
+        Arguments:
+        path (string): Path to a CSV with one row per transaction, or per transaction input/output
+        columns (tuple): Columns to read; must include 'block_timestamp' as unix seconds or timestamp strings
+        chunk_rows (int): Rows per chunk
+
+        Returns:
+            Generator of Pandas dataframes
+
+        """
+    for chunk in pd.read_csv(path, usecols=list(columns), chunksize=chunk_rows):
+        timestamps = chunk['block_timestamp']
+        if pd.api.types.is_numeric_dtype(timestamps):
+            datetimes = pd.to_datetime(timestamps, unit='s')
+        else:
+            datetimes = pd.to_datetime(timestamps.astype(str).str[:19])
+        chunk['date'] = datetimes.dt.strftime('%Y-%m-%d')
+        yield chunk
@@ -0,0 +1,286 @@
+import numpy as np
+import pandas as pd
+
+# Close time used for channels that are still open
+OPEN_SENTINEL = np.iinfo(np.int64).max
+
+def _to_seconds(series, missing=OPEN_SENTINEL):
+    ''' Convert datetimes, date strings or unix seconds to int64 unix seconds, mapping missing values to `missing` '''
+    if pd.api.types.is_numeric_dtype(series):
+        values = series.to_numpy(dtype=np.float64, na_value=np.nan)
+        missing_mask = ~np.isfinite(values) | (values <= 0)
+        seconds = np.where(missing_mask, 0, values).astype(np.int64)
+    else:
+        datetimes = pd.to_datetime(series)
+        seconds = datetimes.values.astype('datetime64[s]').astype(np.int64)
+        # A 0 timestamp parsed as a datetime, e.g. pd.to_datetime(close_ts * 1e9), is 1970-01-01 and still missing
+        missing_mask = datetimes.isna().values | (seconds <= 0)
+    seconds[missing_mask] = missing
+    return seconds
+
+def _query_seconds(ts):
+    if isinstance(ts, (int, np.integer, float, np.floating)):
+        return np.int64(ts)
+    return np.datetime64(pd.Timestamp(ts).to_datetime64(), 's').astype(np.int64)
+
+class ChannelIndex:
+    """
+        Lightning channel lifetimes indexed for point-in-time and range queries
+
+        Channels are open over [open_ts, close_ts). Open and close times are kept in two sorted arrays with
+        cumulative capacities, so counts and capacity at a time are two binary searches, and node pubkeys are mapped
+        to dense integer ids.
+
+        Arguments:
+        channels (dataframe): Pandas dataframe with one row per channel, e.g. ln_channels.csv
+        open_col (string): Column with open time, as unix seconds or datetimes
+        close_col (string): Column with close time; missing, 0 or the 1970-01-01 epoch means the channel is still open
+        node_cols (tuple): The two columns holding the channel's node pubkeys
+        capacity_col (string): Column with channel capacity in sats
+
+        """
+    def __init__(self, channels, open_col='open_ts', close_col='close_ts', node_cols=('node1_pub', 'node2_pub'),
+                 capacity_col='capacity'):
+        self.channels = channels
+        self.opens = _to_seconds(channels[open_col], missing=0)
+        self.closes = _to_seconds(channels[close_col])
+        self.capacity = channels[capacity_col].to_numpy(dtype=np.float64) if capacity_col else \
+            np.zeros(len(channels))
+
+        node_ids, self.node_keys = pd.factorize(
+            np.concatenate([channels[node_cols[0]].values, channels[node_cols[1]].values]))
+        self.node1 = node_ids[:len(channels)]
+        self.node2 = node_ids[len(channels):]
+
+        self.open_order = np.argsort(self.opens, kind='stable')
+        self.sorted_opens = self.opens[self.open_order]
+        self.close_order = np.argsort(self.closes, kind='stable')
+        self.sorted_closes = self.closes[self.close_order]
+        self.opened_capacity = np.concatenate([[0], np.cumsum(self.capacity[self.open_order])])
+        self.closed_capacity = np.concatenate([[0], np.cumsum(self.capacity[self.close_order])])
+
+        self.activations, self.deactivations = self._node_activity_events()
+
+    def _node_activity_events(self):
+        ''' Sorted times at which each node goes from zero to one open channel, and from one to zero '''
+        n_channels = len(self.opens)
+        nodes = np.concatenate([self.node1, self.node2, self.node1, self.node2])
+        times = np.concatenate([self.opens, self.opens, self.closes, self.closes])
+        deltas = np.concatenate([np.ones(2 * n_channels, dtype=np.int64), -np.ones(2 * n_channels, dtype=np.int64)])
+
+        # Opens before closes at equal times, so a node never dips below zero channels
+        order = np.lexsort((-deltas, times, nodes))
+        nodes, times, deltas = nodes[order], times[order], deltas[order]
+
+        running = np.cumsum(deltas)
+        group_starts = np.flatnonzero(np.r_[True, nodes[1:] != nodes[:-1]])
+        offsets = np.repeat((running - deltas)[group_starts], np.diff(np.r_[group_starts, len(nodes)]))
+        degree_after = running - offsets
+        degree_before = degree_after - deltas
+
+        activations = np.sort(times[(degree_before == 0) & (degree_after > 0)])
+        deactivations = np.sort(times[(degree_before > 0) & (degree_after == 0)])
+        return activations, deactivations
+
+    def count_open_at(self, ts):
+        ''' Number of channels open at ts '''
+        ts = _query_seconds(ts)
+        return int(np.searchsorted(self.sorted_opens, ts, side='right')
+                   - np.searchsorted(self.sorted_closes, ts, side='right'))
+
+    def capacity_open_at(self, ts):
+        ''' Total capacity of channels open at ts '''
+        ts = _query_seconds(ts)
+        return float(self.opened_capacity[np.searchsorted(self.sorted_opens, ts, side='right')]
+                     - self.closed_capacity[np.searchsorted(self.sorted_closes, ts, side='right')])
+
+    def count_active_nodes_at(self, ts):
+        ''' Number of nodes with at least one open channel at ts '''
+        ts = _query_seconds(ts)
+        return int(np.searchsorted(self.activations, ts, side='right')
+                   - np.searchsorted(self.deactivations, ts, side='right'))
+
+    def count_open_during(self, start, end):
+        ''' Number of channels open at any point in [start, end] '''
+        start, end = _query_seconds(start), _query_seconds(end)
+        opened_after = len(self.sorted_opens) - np.searchsorted(self.sorted_opens, end, side='right')
+        closed_before = np.searchsorted(self.sorted_closes, start, side='right')
+        return int(len(self.sorted_opens) - opened_after - closed_before)
+
+    def channels_open_at(self, ts):
+        ''' Rows of the channels dataframe open at ts '''
+        return self.channels_open_during(ts, ts)
+
+    def channels_open_during(self, start, end):
+        ''' Rows of the channels dataframe open at any point in [start, end] '''
+        start, end = _query_seconds(start), _query_seconds(end)
+        candidates = self.open_order[:np.searchsorted(self.sorted_opens, end, side='right')]
+        candidates = np.sort(candidates[self.closes[candidates] > start])
+        return self.channels.iloc[candidates]
+
+    def nodes_active_at(self, ts):
+        ''' Pubkeys of nodes with at least one channel open at ts '''
+        ts = _query_seconds(ts)
+        channels = self.open_order[:np.searchsorted(self.sorted_opens, ts, side='right')]
+        channels = channels[self.closes[channels] > ts]
+        return self.node_keys[np.unique(np.concatenate([self.node1[channels], self.node2[channels]]))]
+
+    def daily_series(self, start=None, end=None, freq='D'):
+        """
+            Open channels, open capacity and active nodes at the start of every period, in one sweep
+
+            Arguments:
+            start (string): First date; defaults to the first channel open
+            end (string): Last date; defaults to the last finite open or close time
+            freq (string): Pandas frequency for the snapshots
+
+            Returns:
+                Pandas dataframe with 'date' ('%Y-%m-%d'), 'open_channels', 'capacity' and 'active_nodes' columns,
+                ready for chart_utils.single_axis_chart2
+
+            """
+        finite_closes = self.sorted_closes[self.sorted_closes != OPEN_SENTINEL]
+        if start is None:
+            start = pd.to_datetime(self.sorted_opens[0], unit='s').normalize()
+        if end is None:
+            end = pd.to_datetime(max(self.sorted_opens[-1], finite_closes[-1] if len(finite_closes) else 0), unit='s')
+        grid = pd.date_range(pd.Timestamp(start), pd.Timestamp(end), freq=freq)
+        ts = grid.values.astype('datetime64[s]').astype(np.int64)
+
+        opened = np.searchsorted(self.sorted_opens, ts, side='right')
+        closed = np.searchsorted(self.sorted_closes, ts, side='right')
+        return pd.DataFrame({
+            'date': grid.strftime('%Y-%m-%d'),
+            'open_channels': opened - closed,
+            'capacity': self.opened_capacity[opened] - self.closed_capacity[closed],
+            'active_nodes': np.searchsorted(self.activations, ts, side='right')
+                            - np.searchsorted(self.deactivations, ts, side='right'),
+        })
+
+LIGHTNING_TX_TYPES = ['channel_open', 'channel_close']
+TXID_BYTES = 32
+
+def txids_to_keys(txids):
+    ''' Convert hex txid strings to a numpy array of 32-byte keys '''
+    txids = [str(x) for x in txids]
+    return np.frombuffer(bytes.fromhex(''.join(txids)), dtype='S{}'.format(TXID_BYTES)) if txids else \
+        np.array([], dtype='S{}'.format(TXID_BYTES))
+
+class TxidIndex:
+    """
+        Compact membership index for Lightning channel open/close txids
+
+        Keys are stored sorted as 32-byte values in a single buffer and found by binary search. A Bloom filter in
+        front rejects almost all non-Lightning txids without touching the sorted keys. Txids are already uniformly
+        distributed hashes, so the Bloom filter positions are taken directly from the key bytes.
+
+        Arguments:
+        txids (list): Hex txid strings, e.g. the txid column of bitcoinkpis.misc.lightning_txids
+        types (list): Matching 'channel_open' / 'channel_close' type for each txid
+        bits_per_key (int): Bloom filter size; 10 bits per key with 7 hashes gives about a 1% false positive rate
+        n_hashes (int): Bloom filter hash count
+
+        """
+    def __init__(self, txids, types, bits_per_key=10, n_hashes=7):
+        keys = txids_to_keys(txids)
+        codes = pd.Categorical(types, categories=LIGHTNING_TX_TYPES).codes.astype(np.int8)
+        keys, first = np.unique(keys, return_index=True)
+        self.keys = keys
+        self.types = codes[first]
+
+        self.n_hashes = n_hashes
+        self.n_bits = np.uint64(max(64, len(keys) * bits_per_key))
+        self.bloom = np.zeros(int(self.n_bits) // 8 + 1, dtype=np.uint8)
+        positions = self._bloom_positions(keys).ravel()
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bloom, positions >> np.uint64(3), masks)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _bloom_positions(self, keys):
+        words = np.frombuffer(keys.tobytes(), dtype='<u8').reshape(-1, TXID_BYTES // 8)
+        h1, h2 = words[:, 0], words[:, 1] | np.uint64(1)
+        steps = np.arange(self.n_hashes, dtype=np.uint64)
+        return (h1[:, None] + steps[None, :] * h2[:, None]) % self.n_bits
+
+    def might_contain(self, keys):
+        ''' Bloom filter test: False means the key is definitely not a Lightning txid '''
+        positions = self._bloom_positions(keys)
+        bits = (self.bloom[positions >> np.uint64(3)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        return bits.all(axis=1)
+
+    def lookup(self, keys):
+        """
+            Classify 32-byte txid keys
+
+            Arguments:
+            keys (array): Numpy 'S32' array, e.g. from txids_to_keys
+
+            Returns:
+                Numpy int8 array of indexes into LIGHTNING_TX_TYPES, -1 where the txid is not a Lightning txid
+
+            """
+        codes = np.full(len(keys), -1, dtype=np.int8)
+        if len(keys) == 0 or len(self.keys) == 0:
+            return codes
+        candidates = np.flatnonzero(self.might_contain(keys))
+        positions = np.minimum(np.searchsorted(self.keys, keys[candidates]), len(self.keys) - 1)
+        found = self.keys[positions] == keys[candidates]
+        codes[candidates[found]] = self.types[positions[found]]
+        return codes
+
+    def classify(self, txids):
+        ''' 'channel_open', 'channel_close' or None for each hex txid '''
+        codes = self.lookup(txids_to_keys(txids))
+        return np.array(LIGHTNING_TX_TYPES + [None], dtype=object)[codes]
+
+class LightningFeeAggregator:
+    """
+        Daily Lightning fee totals computed from a transaction stream, matching queries/lightning_fees.sql
+
+        Feed it transaction chunks (e.g. from ingest_utils.iter_transaction_chunks, or one block at a time) with
+        update(), then call to_frame().
+
+        Arguments:
+        index (TxidIndex): Lightning txid index
+
+        """
+    def __init__(self, index):
+        self.index = index
+        self.daily = None
+
+    def update(self, transactions, date_col='date', hash_col='hash', fee_col='fee'):
+        codes = self.index.lookup(txids_to_keys(transactions[hash_col]))
+        fees = transactions[fee_col].to_numpy(dtype=np.float64)
+        sums = pd.DataFrame({
+            'date': transactions[date_col].values,
+            'total_fees': fees,
+            'channel_open_fees': np.where(codes == 0, fees, 0),
+            'channel_close_fees': np.where(codes == 1, fees, 0),
+        }).groupby('date').sum()
+        self.daily = sums if self.daily is None else self.daily.add(sums, fill_value=0)
+        return self
+
+    def to_frame(self):
+        ''' Daily frame with the columns of data/lightning_fees.csv, fees in BTC '''
+        columns = ['date', 'total_fees', 'channel_open_fees', 'channel_close_fees', 'lightning_fees', 'lightning_pct']
+        if self.daily is None:
+            return pd.DataFrame(columns=columns)
+        df = self.daily.sort_index()
+        lightning_fees = df['channel_open_fees'] + df['channel_close_fees']
+        return pd.DataFrame({
+            'date': df.index.values,
+            'total_fees': df['total_fees'].values * 1e-8,
+            'channel_open_fees': df['channel_open_fees'].values * 1e-8,
+            'channel_close_fees': df['channel_close_fees'].values * 1e-8,
+            'lightning_fees': lightning_fees.values * 1e-8,
+            'lightning_pct': (lightning_fees / df['total_fees']).values,
+        }, columns=columns)
+
+def lightning_fees(transaction_chunks, index):
+    ''' Build the data/lightning_fees.csv frame locally from an iterable of transaction chunks '''
+    aggregator = LightningFeeAggregator(index)
+    for chunk in transaction_chunks:
+        aggregator.update(chunk)
+    return aggregator.to_frame()
@@ -0,0 +1,219 @@
+import numpy as np
+import pandas as pd
+
+import analysis_utils
+
+def hash_addresses(addresses):
+    ''' 64-bit keys for address strings '''
+    return pd.util.hash_array(np.asarray(addresses, dtype=object))
+
+class AddressEntityIndex:
+    """
+        Compact address to entity (e.g. exchange) index
+
+        Addresses are stored only as sorted 64-bit hashes with a small integer entity code each, so a table of tens of
+        millions of labeled addresses fits in a few hundred MB and a chunk of addresses is matched with one vectorized
+        hash and binary search. With n labeled addresses the chance an unlabeled address matches is about n / 2^64.
+
+        Arguments:
+        addresses (list): Labeled addresses
+        entities (list): Matching entity name for each address, e.g. 'binance'
+
+        """
+    def __init__(self, addresses, entities):
+        codes, self.entities = pd.factorize(np.asarray(entities, dtype=object))
+        if len(self.entities) > np.iinfo(np.int32).max:
+            raise ValueError('Too many entities for int32 codes: {}'.format(len(self.entities)))
+        self.code_dtype = np.int16 if len(self.entities) <= np.iinfo(np.int16).max else np.int32
+        keys, first = np.unique(hash_addresses(addresses), return_index=True)
+        self.keys = keys
+        self.codes = codes[first].astype(self.code_dtype)
+
+    @classmethod
+    def from_csv(cls, path, address_col='address', entity_col='entity'):
+        ''' Build the index from a labeled-address table with one row per address '''
+        labels = pd.read_csv(path, usecols=[address_col, entity_col], dtype=str)
+        return cls(labels[address_col].values, labels[entity_col].values)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, addresses):
+        """
+            Entity codes for a chunk of addresses
+
+            Arguments:
+            addresses (array): Address strings
+
+            Returns:
+                Numpy int16 (int32 above 32,767 entities) array of indexes into self.entities, -1 where the address is
+                not labeled
+
+            """
+        codes = np.full(len(addresses), -1, dtype=self.code_dtype)
+        if len(addresses) == 0 or len(self.keys) == 0:
+            return codes
+        keys = hash_addresses(addresses)
+        positions = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[positions] == keys
+        codes[found] = self.codes[positions[found]]
+        return codes
+
+    def entity_of(self, addresses):
+        ''' Entity name or None for each address '''
+        return np.append(np.asarray(self.entities, dtype=object), None)[self.lookup(addresses)]
+
+class NetflowAggregator:
+    """
+        Per-entity inflow, outflow, netflow and balance from a stream of transaction inputs and outputs
+
+        Each row is one input or output (see queries/exchange_netflow_io.sql). For every transaction and entity the
+        net is the value of outputs to the entity's addresses minus the value of inputs spent from them; positive nets
+        are inflow and negative nets outflow, so change returned to the same entity is not counted. Rows must arrive
+        grouped by transaction; the last transaction of each chunk is held back until the next chunk in case it is
+        split across chunks.
+
+        Arguments:
+        index (AddressEntityIndex): Labeled addresses
+        period_col (string): Column to aggregate by, 'date' for daily flows or e.g. 'block_number'
+
+        """
+    def __init__(self, index, period_col='date'):
+        self.index = index
+        self.period_col = period_col
+        self.flows = None
+        self.initial_balances = {}
+        self._pending = None
+
+    @classmethod
+    def from_frame(cls, index, flows, period_col='date'):
+        """
+            Resume from a previous to_frame() result, e.g. to add one more day of blocks
+
+            The initial balances the frame was built with are recovered as each entity's balance minus its cumulative
+            netflow, so later to_frame() calls keep the same balance line without passing them again.
+
+            """
+        aggregator = cls(index, period_col)
+        aggregator.flows = flows.set_index([period_col, 'entity'])[['inflow', 'outflow']] * 1e8
+        ordered = flows.sort_values(period_col, kind='stable')
+        offsets = ordered['balance'] - ordered.groupby('entity')['netflow'].cumsum()
+        aggregator.initial_balances = {
+            entity: value for entity, value in offsets.groupby(ordered['entity']).first().items() if value}
+        return aggregator
+
+    def update(self, io_rows, hash_col='hash', address_col='address', value_col='value', input_col='is_input'):
+        """
+            Add a chunk of input/output rows
+
+            Arguments:
+            io_rows (dataframe): Pandas dataframe with the transaction hash, period_col, address, value in sats and a
+                boolean column that is true for inputs, e.g. a chunk from ingest_utils.iter_transaction_chunks
+
+            """
+        codes = self.index.lookup(io_rows[address_col].values)
+        labeled = codes >= 0
+        values = io_rows[value_col].to_numpy(dtype=np.float64)[labeled]
+        is_input = io_rows[input_col].to_numpy(dtype=bool)[labeled]
+        rows = pd.DataFrame({
+            'hash': io_rows[hash_col].values[labeled],
+            'period': io_rows[self.period_col].values[labeled],
+            'entity': codes[labeled],
+            'net': np.where(is_input, -values, values),
+        })
+
+        if self._pending is not None:
+            rows = pd.concat([self._pending, rows], ignore_index=True)
+        last_hash = io_rows[hash_col].values[-1] if len(io_rows) else None
+        held = (rows['hash'] == last_hash).values
+        self._pending = rows.loc[held]
+        self._add(rows.loc[~held])
+        return self
+
+    def flush(self):
+        ''' Count the held-back last transaction; called by to_frame '''
+        if self._pending is not None:
+            self._add(self._pending)
+            self._pending = None
+        return self
+
+    def _add(self, rows):
+        if len(rows) == 0:
+            return
+        net = rows.groupby(['period', 'hash', 'entity'], sort=False)['net'].sum()
+        values = net.to_numpy()
+        flows = pd.DataFrame({
+            'inflow': np.clip(values, 0, None),
+            'outflow': np.clip(-values, 0, None),
+        }, index=net.index.droplevel('hash')).groupby(level=['period', 'entity']).sum()
+        flows.index = flows.index.set_levels(
+            self.index.entities[flows.index.levels[1]], level='entity').set_names([self.period_col, 'entity'])
+        self.flows = flows if self.flows is None else self.flows.add(flows, fill_value=0)
+
+    def to_frame(self, initial_balances=None):
+        """
+            Flows per period and entity in BTC
+
+            Arguments:
+            initial_balances (dict): Entity to BTC balance before the first period, for streams that do not start at
+                genesis. Defaults to the balances recovered by from_frame.
+
+            Returns:
+                Pandas dataframe with period_col, entity, inflow, outflow, netflow and the running balance, with zero
+                flows for periods where an entity had no activity
+
+            """
+        self.flush()
+        columns = [self.period_col, 'entity', 'inflow', 'outflow', 'netflow', 'balance']
+        if self.flows is None:
+            return pd.DataFrame(columns=columns)
+        # Every entity gets a row for every period so running balances and rolling means step one period at a time
+        periods = pd.MultiIndex.from_product([self.flows.index.unique(0), self.flows.index.unique(1)])
+        df = (self.flows.reindex(periods, fill_value=0).sort_index() * 1e-8).rename_axis(
+            [self.period_col, 'entity']).reset_index()
+        df['netflow'] = df['inflow'] - df['outflow']
+        df['balance'] = df.groupby('entity')['netflow'].cumsum()
+        initial_balances = self.initial_balances if initial_balances is None else initial_balances
+        if initial_balances:
+            df['balance'] += df['entity'].map(initial_balances).fillna(0)
+        return df[columns]
+
+def exchange_netflows(io_chunks, index, period_col='date', initial_balances=None):
+    ''' Per-entity flows computed locally from an iterable of input/output chunks '''
+    aggregator = NetflowAggregator(index, period_col)
+    for chunk in io_chunks:
+        aggregator.update(chunk)
+    return aggregator.to_frame(initial_balances)
+
+def pivot_entities(flows, value='balance', period_col='date'):
+    ''' One column per entity, as the exchange balance exports charted in ExchangeBalance.ipynb '''
+    wide = flows.pivot(index=period_col, columns='entity', values=value)
+    if value == 'balance':
+        wide = wide.ffill()
+    else:
+        wide = wide.fillna(0)
+    wide.columns.name = None
+    return wide.reset_index()
+
+def netflow_usd(flows, price, window=28):
+    """
+        Value flows in USD and add rolling means, as ExchangeNetflowUSD.ipynb does with the downloaded netflow export
+
+        Arguments:
+        flows (dataframe): Daily to_frame() output, optionally filtered to one entity
+        price (dataframe): Pandas dataframe with 'date' and 'PriceUSD', e.g. CoinMetrics btc.csv
+        window (int): Rolling mean window in days
+
+        Returns:
+            Pandas dataframe with netflow_usd and {column}_{window}dma columns per entity, and the extra datetime
+            columns for charting
+
+        """
+    df = flows.merge(price[['date', 'PriceUSD']], on='date')
+    for col in ['inflow', 'outflow', 'netflow']:
+        df['{}_usd'.format(col)] = df[col] * df['PriceUSD']
+    rolling = df.groupby('entity')[['netflow', 'netflow_usd', 'inflow_usd', 'outflow_usd']].rolling(window).mean()
+    rolling = rolling.reset_index(level=0, drop=True)
+    for col in rolling.columns:
+        df['{}_{}dma'.format(col, window)] = rolling[col]
+    return analysis_utils.get_extra_datetime_cols(df, 'date')
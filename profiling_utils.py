@@ -0,0 +1,249 @@
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Instrumentation is enabled while there is at least one sink. When disabled, span() returns a shared no-op context
+# manager and the public functions of the instrumented modules are the originals, so there is no per-call overhead.
+_sinks = []
+_trace_memory = False
+_started_tracemalloc = False
+_wrapped = {}
+_local = threading.local()
+_NULL_SPAN = contextlib.nullcontext()
+
+# Scalar helpers called once per row; a span per call would swamp the sinks and the timings
+PER_ROW_FUNCTIONS = {'get_halving_era', 'get_market_cycle', 'sats_fee_bucket', 'usd_fee_bucket', 'colorFader'}
+
+class LogSink:
+    ''' Log one line per span '''
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def emit(self, record):
+        self.log.log(
+            self.level, '%s%s: %.4fs rows=%s allocated=%s figure_bytes=%s',
+            '  ' * record['depth'], record['name'], record['seconds'], record['rows'],
+            record['allocated_bytes'], record['figure_bytes'])
+
+    def close(self):
+        pass
+
+class SummarySink:
+    ''' Keep every span in memory and summarize them per name '''
+    def __init__(self):
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+    def summary(self):
+        """
+            Summarize recorded spans
+
+            Returns:
+                Pandas dataframe with one row per span name: call count, total/mean/max seconds, max rows,
+                total allocated bytes and max figure bytes, sorted by total seconds
+
+            """
+        columns = ['name', 'seconds', 'rows', 'allocated_bytes', 'figure_bytes']
+        df = pd.DataFrame(self.records, columns=columns)
+        return df.groupby('name').agg(
+            calls=('seconds', 'size'),
+            total_seconds=('seconds', 'sum'),
+            mean_seconds=('seconds', 'mean'),
+            max_seconds=('seconds', 'max'),
+            max_rows=('rows', 'max'),
+            allocated_bytes=('allocated_bytes', 'sum'),
+            figure_bytes=('figure_bytes', 'max'),
+        ).sort_values('total_seconds', ascending=False)
+
+class ChromeTraceSink:
+    ''' Write spans as a Chrome trace JSON file, viewable in chrome://tracing or Perfetto '''
+    def __init__(self, path):
+        self.path = path
+        self.events = []
+
+    def emit(self, record):
+        args = {k: record[k] for k in ['rows', 'allocated_bytes', 'figure_bytes'] if record[k] is not None}
+        self.events.append({
+            'name': record['name'], 'ph': 'X', 'pid': os.getpid(), 'tid': record['thread'],
+            'ts': record['start'] * 1e6, 'dur': record['seconds'] * 1e6, 'args': args,
+        })
+
+    def close(self):
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+class _Span:
+    def __init__(self, name, rows=None, emit=True, figure=None):
+        self.name = name
+        self.rows = rows
+        self.auto_emit = emit
+        self.figure = figure
+        self.figure_bytes = None
+        # Time spent measuring figures inside this span, left out of its seconds
+        self.overhead = 0.0
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        self.depth = len(_local.stack)
+        _local.stack.append(self)
+        self.memory_start = tracemalloc.get_traced_memory()[0] if _trace_memory else None
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start - self.overhead
+        allocated = tracemalloc.get_traced_memory()[0] - self.memory_start if _trace_memory else None
+        _local.stack.pop()
+        if self.figure is not None:
+            self.measure(self.figure)
+        self.record = {
+            'name': self.name, 'start': self.start, 'seconds': seconds, 'rows': self.rows,
+            'allocated_bytes': allocated, 'figure_bytes': self.figure_bytes, 'depth': self.depth,
+            'thread': threading.get_ident(),
+        }
+        if self.auto_emit:
+            self.emit()
+        return False
+
+    def measure(self, figure):
+        ''' Record the figure's size on this span and on enclosing spans that have none, without timing it '''
+        start = time.perf_counter()
+        figure_bytes = _figure_bytes(figure)
+        if figure_bytes is not None:
+            self.figure_bytes = figure_bytes
+            for parent in _local.stack:
+                if parent.figure_bytes is None:
+                    parent.figure_bytes = figure_bytes
+        elapsed = time.perf_counter() - start
+        for parent in _local.stack:
+            parent.overhead += elapsed
+
+    def emit(self):
+        for sink in _sinks:
+            sink.emit(self.record)
+
+def span(name, rows=None, figure=None):
+    """
+        Time a named stage, e.g. `with profiling_utils.span('block_space_price_heatmap.savefig', figure=fig):`
+
+        Arguments:
+        name (string): Span name
+        rows (int): Optional row count to record with the span
+        figure (object): Optional Plotly or matplotlib figure whose size is recorded with the span and its enclosing
+            function span, for chart functions that show the figure instead of returning it
+
+        Returns:
+            Context manager; a shared no-op when instrumentation is disabled
+
+        """
+    if not _sinks:
+        return _NULL_SPAN
+    return _Span(name, rows, figure=figure)
+
+def _row_count(args, kwargs):
+    for arg in list(args) + list(kwargs.values()):
+        shape = getattr(arg, 'shape', None)
+        if shape:
+            return int(shape[0])
+    return None
+
+def _figure_bytes(result):
+    if hasattr(result, 'to_plotly_json') and hasattr(result, 'to_json'):
+        return len(result.to_json())
+    if hasattr(result, 'get_size_inches') and hasattr(result, 'dpi'):
+        width, height = result.get_size_inches() * result.dpi
+        return int(width * height * 4)
+    return None
+
+def _instrument(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _sinks:
+            return func(*args, **kwargs)
+        # Returned figures are measured after the span closes; shown figures are measured by the nested show/save
+        # span, which fills in this span's figure_bytes
+        with _Span(name, _row_count(args, kwargs), emit=False) as s:
+            result = func(*args, **kwargs)
+        if s.record['figure_bytes'] is None:
+            s.record['figure_bytes'] = _figure_bytes(result)
+        s.emit()
+        return result
+    return wrapper
+
+def default_modules():
+    import analysis_utils
+    import chart_utils
+    return [analysis_utils, chart_utils]
+
+def enable(*sinks, trace_memory=False, modules=None):
+    """
+        Turn on instrumentation and wrap the public functions of the given modules with named spans
+
+        Arguments:
+        sinks: LogSink, SummarySink and/or ChromeTraceSink instances. Defaults to a LogSink.
+
+        Keyword arguments:
+        trace_memory (bool): Record memory allocated during each span using tracemalloc. Slows traced code down.
+        modules (list): Modules to instrument. Defaults to analysis_utils and chart_utils.
+
+        Returns:
+            List of sinks
+
+        """
+    global _trace_memory, _started_tracemalloc
+    disable()
+    _sinks[:] = list(sinks) or [LogSink()]
+    _trace_memory = trace_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _started_tracemalloc = True
+
+    for module in modules or default_modules():
+        for attr, obj in list(vars(module).items()):
+            if attr.startswith('_') or attr in PER_ROW_FUNCTIONS:
+                continue
+            if not inspect.isfunction(obj) or obj.__module__ != module.__name__:
+                continue
+            _wrapped[(module, attr)] = obj
+            setattr(module, attr, _instrument(obj, '{}.{}'.format(module.__name__, attr)))
+    return _sinks
+
+def disable():
+    ''' Restore the original functions, close the sinks (writing any trace file) and turn instrumentation off '''
+    global _trace_memory, _started_tracemalloc
+    for (module, attr), obj in _wrapped.items():
+        setattr(module, attr, obj)
+    _wrapped.clear()
+    for sink in _sinks:
+        sink.close()
+    _sinks[:] = []
+    if _started_tracemalloc:
+        tracemalloc.stop()
+        _started_tracemalloc = False
+    _trace_memory = False
+
+@contextlib.contextmanager
+def instrumented(*sinks, trace_memory=False, modules=None):
+    ''' Context manager around enable()/disable() '''
+    enable(*sinks, trace_memory=trace_memory, modules=modules)
+    try:
+        yield _sinks
+    finally:
+        disable()
@@ -0,0 +1,31 @@
+-- One row per input and output, for netflow_utils.NetflowAggregator via ingest_utils.iter_transaction_chunks.
+-- Multisig scripts list several addresses; only the first is kept so each input/output's value is counted once.
+SELECT
+    tx.hash AS hash
+  , tx.block_number AS block_number
+  , tx.block_timestamp AS block_timestamp
+  , address
+  , inputs.value AS value
+  , TRUE AS is_input
+FROM `bigquery-public-data.crypto_bitcoin.transactions` AS tx,
+    tx.inputs AS inputs,
+    UNNEST(inputs.addresses) AS address WITH OFFSET AS address_offset
+WHERE tx.block_timestamp_month >= "2017-01-01"
+  AND address_offset = 0
+
+UNION ALL
+
+SELECT
+    tx.hash AS hash
+  , tx.block_number AS block_number
+  , tx.block_timestamp AS block_timestamp
+  , address
+  , outputs.value AS value
+  , FALSE AS is_input
+FROM `bigquery-public-data.crypto_bitcoin.transactions` AS tx,
+    tx.outputs AS outputs,
+    UNNEST(outputs.addresses) AS address WITH OFFSET AS address_offset
+WHERE tx.block_timestamp_month >= "2017-01-01"
+  AND address_offset = 0
+
+ORDER BY block_number, hash
@@ -0,0 +1,237 @@
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import inspect
+import io
+import json
+import os
+import sys
+import time
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+MANIFEST_FILE = os.path.join(ROOT_DIR, 'render_manifest.json')
+CACHE_FILE = os.path.join(ROOT_DIR, 'img', '.render_cache.json')
+IMG_DIR = os.path.join(ROOT_DIR, 'img')
+DOCS_DIR = os.path.join(ROOT_DIR, 'docs')
+
+def load_manifest(path=MANIFEST_FILE):
+    """
+        Read a chart job manifest
+
+        The manifest is a JSON list of jobs, each a dict with:
+            name (str): Output file stem, written to img/<name>.png and docs/<name>.html
+            function (str): chart_utils function, e.g. 'hodl_waves_chart'
+            dataset (str): CSV path relative to the repo, e.g. 'data/03_hodl_waves_real_cap.csv'
+            prepare (str): Optional name of a PREPARE_FUNCTIONS entry that turns the dataset into the chart's leading
+                positional arguments, for charts that take more than one dataframe. Default passes the dataset alone.
+            price_dataset (str): Optional second CSV path for the prepare function, e.g. CoinMetrics 'btc.csv'
+            args (list): Positional arguments after the prepared arguments
+            kwargs (dict): Keyword arguments for the chart function
+            rename (dict): Optional column renames applied to the dataset
+            query (str): Optional DataFrame.query filter applied to the dataset
+            sort_by (str): Optional column to sort the dataset by
+            formats (list): Outputs to write, 'html' and/or 'png', default ['html']. Matplotlib charts write png
+                directly; Plotly png export needs kaleido, which is not installed with the repo.
+
+        Returns:
+            List of job dicts
+
+        """
+    with open(path) as f:
+        return json.load(f)
+
+def _file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def job_hash(job, root=ROOT_DIR):
+    ''' Hash of everything that determines a job's output: the job spec, its dataset and the chart code '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps(job, sort_keys=True).encode())
+    for dataset in [job['dataset'], job.get('price_dataset')]:
+        if dataset:
+            digest.update(_file_digest(os.path.join(root, dataset)).encode())
+    for module in ['chart_utils.py', 'analysis_utils.py', 'render_utils.py']:
+        digest.update(_file_digest(os.path.join(root, module)).encode())
+    return digest.hexdigest()
+
+def job_outputs(job, img_dir=IMG_DIR, docs_dir=DOCS_DIR):
+    ''' Paths written by a job, keyed by format '''
+    outputs = {}
+    for fmt in job.get('formats', ['html']):
+        if fmt == 'html':
+            outputs['html'] = os.path.join(docs_dir, '{}.html'.format(job['name']))
+        elif fmt == 'png':
+            outputs['png'] = os.path.join(img_dir, '{}.png'.format(job['name']))
+        else:
+            raise ValueError('Unknown output format {} for {}'.format(fmt, job['name']))
+    return outputs
+
+def prepare_block_space_heatmap(df, job, root=ROOT_DIR):
+    """
+        Arguments for chart_utils.block_space_price_heatmap, built as in 04_BlockSpaceMarket.ipynb
+
+        Arguments:
+        df (dataframe): data/04_block_space_price_heat.csv
+        job (dict): Manifest entry; kwargs['type'] picks the 'sats' or 'usd' buckets and price_dataset names the
+            CoinMetrics daily csv with TxTfrValNtv and TxTfrValUSD
+
+        Returns:
+            List of monthly bucket counts, month labels and monthly mean transaction volumes
+
+        """
+    import pandas as pd
+
+    # 'January 2017' style labels, which the heatmap uses for its year ticks and SegWit marker
+    fee_data = df.sort_values('month', kind='stable')
+    fee_data['month_string'] = pd.to_datetime(fee_data['month']).dt.strftime('%B %Y')
+    months = fee_data['month_string'].unique()
+    fee_type = job.get('kwargs', {}).get('type', 'sats')
+    aggregate_data = fee_data.loc[fee_data['bucket_type'] == fee_type].groupby(
+        ['month_string', 'bucket'])[['tx_count']].sum()
+
+    price_data = pd.read_csv(os.path.join(root, job['price_dataset']))
+    price_data['month_string'] = pd.to_datetime(price_data['date']).dt.strftime('%B %Y')
+    price_data['transaction_volume_usd'] = price_data['TxTfrValUSD'].rolling(28).mean()
+    price_data['transaction_volume_btc'] = price_data['TxTfrValNtv'].rolling(28).mean()
+    price_data_monthly = price_data.groupby('month_string')[['transaction_volume_btc', 'transaction_volume_usd']].mean()
+    return [aggregate_data, months, price_data_monthly]
+
+PREPARE_FUNCTIONS = {
+    'block_space_heatmap': prepare_block_space_heatmap,
+}
+
+def render_job(job, outputs, root=ROOT_DIR):
+    """
+        Build one chart and write its outputs. Runs inside a worker process.
+
+        Arguments:
+        job (dict): Manifest entry
+        outputs (dict): Format to output path, from job_outputs
+
+        Returns:
+            Seconds spent rendering
+
+        """
+    start = time.perf_counter()
+    import matplotlib
+    matplotlib.use('Agg')
+    import pandas as pd
+    import chart_utils
+
+    df = pd.read_csv(os.path.join(root, job['dataset']))
+    if job.get('rename'):
+        df = df.rename(columns=job['rename'])
+    if job.get('query'):
+        df = df.query(job['query'])
+    if job.get('sort_by'):
+        df = df.sort_values(job['sort_by'])
+    df = df.reset_index(drop=True)
+    prepared = PREPARE_FUNCTIONS[job['prepare']](df, job, root) if job.get('prepare') else [df]
+
+    func = getattr(chart_utils, job['function'])
+    kwargs = dict(job.get('kwargs', {}))
+    parameters = inspect.signature(func).parameters
+    if any(p.kind == p.VAR_KEYWORD for p in parameters.values()) or 'show' in parameters:
+        kwargs['show'] = False
+        # Outputs are written below; keep charts with a default save_file from also writing one
+        kwargs.setdefault('save_file', None)
+    fig = func(*prepared, *job.get('args', []), **kwargs)
+
+    if hasattr(fig, 'to_html'):
+        if 'html' in outputs:
+            with open(outputs['html'], 'w') as f:
+                f.write(fig.to_html(full_html=False, include_plotlyjs='cdn'))
+        if 'png' in outputs:
+            fig.write_image(outputs['png'])
+    else:
+        import matplotlib.pyplot as plt
+        buffer = io.BytesIO()
+        fig.savefig(buffer, format='png')
+        plt.close(fig)
+        if 'png' in outputs:
+            with open(outputs['png'], 'wb') as f:
+                f.write(buffer.getvalue())
+        if 'html' in outputs:
+            with open(outputs['html'], 'w') as f:
+                f.write('<img src="data:image/png;base64,{}" alt="{}">\n'.format(
+                    base64.b64encode(buffer.getvalue()).decode(), job['name']))
+    return time.perf_counter() - start
+
+def render_all(jobs, workers=None, force=False, cache_file=CACHE_FILE, img_dir=IMG_DIR, docs_dir=DOCS_DIR,
+               root=ROOT_DIR):
+    """
+        Render chart jobs across a process pool, skipping jobs whose inputs are unchanged since the last render
+
+        Arguments:
+        jobs (list): Manifest entries, see load_manifest
+        workers (int): Worker processes; defaults to the CPU count
+        force (bool): Re-render every job
+
+        Returns:
+            Dict of job name to 'rendered', 'cached' or the error message
+
+        """
+    cache = {}
+    if os.path.exists(cache_file) and not force:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    os.makedirs(img_dir, exist_ok=True)
+    os.makedirs(docs_dir, exist_ok=True)
+
+    status = {}
+    pending = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        for job in jobs:
+            try:
+                digest = job_hash(job, root)
+            except FileNotFoundError as e:
+                status[job['name']] = 'Missing input: {}'.format(e.filename)
+                continue
+            outputs = job_outputs(job, img_dir, docs_dir)
+            if cache.get(job['name']) == digest and all(os.path.exists(x) for x in outputs.values()):
+                status[job['name']] = 'cached'
+                continue
+            pending[pool.submit(render_job, job, outputs, root)] = (job['name'], digest)
+
+        for future in concurrent.futures.as_completed(pending):
+            name, digest = pending[future]
+            try:
+                seconds = future.result()
+            except Exception as e:
+                status[name] = '{}: {}'.format(type(e).__name__, e)
+                cache.pop(name, None)
+            else:
+                status[name] = 'rendered'
+                cache[name] = digest
+                print('Rendered {} in {:.2f}s'.format(name, seconds), flush=True)
+
+    with open(cache_file, 'w') as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    return status
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Render chart_utils figures from a manifest into img/ and docs/')
+    parser.add_argument('jobs', nargs='*', help='Job names to render, default all')
+    parser.add_argument('--manifest', default=MANIFEST_FILE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help='Ignore the render cache')
+    args = parser.parse_args(argv)
+
+    jobs = load_manifest(args.manifest)
+    if args.jobs:
+        jobs = [job for job in jobs if job['name'] in args.jobs]
+    status = render_all(jobs, workers=args.workers, force=args.force)
+    failed = False
+    for name in sorted(status):
+        if status[name] not in ('rendered', 'cached'):
+            failed = True
+        print('{:<40} {}'.format(name, status[name]))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())